@@ -11,10 +11,18 @@
 import sys
 import time
 import os
+import re
 import io
 import csv
 import sqlite3
 import codecs
+import threading
+import weakref
+import collections
+import hashlib
+import array
+import mmap
+import struct
 
 try:
     import json
@@ -30,6 +38,7 @@ if sys.version_info[0] >= 3:
     unicode = str
     long = int
     xrange = range
+    unichr = chr
 
 
 # ----------------------------------------------------------------------
@@ -38,15 +47,538 @@ if sys.version_info[0] >= 3:
 def stripword(word):
     return (''.join([n for n in word if n.isalnum()])).lower()
 
+# 排序键：和 sqlite 的 NOCASE 相同，只把 ASCII 大写字母变成小写，
+# 按单词归并两个词典时两边都用它比较
+def word_collate(word):
+    try:
+        word.encode('ascii')
+    except UnicodeError:
+        return ''.join([ord(n) < 128 and n.lower() or n for n in word])
+    return word.lower()
+
+
+# ----------------------------------------------------------------------
+# merge join: 归并两个按 word_collate 排好序并且没有重复的 (word, data)
+# 序列，生成 (word, left, right)，只在一边出现时另一边为 None。只保存
+# 当前的一对，内存占用和序列长度无关，输入没排好序时抛出 ValueError
+# ----------------------------------------------------------------------
+def merge_join(left, right):
+    left = iter(left)
+    right = iter(right)
+    def advance(it, last):
+        item = next(it, None)
+        if item is None:
+            return None, None
+        key = word_collate(item[0])
+        if last is not None and key <= last:
+            raise ValueError('not in word order: %s' % item[0])
+        return item, key
+    a, ka = advance(left, None)
+    b, kb = advance(right, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and ka < kb):
+            yield a[0], a, None
+            a, ka = advance(left, ka)
+        elif a is None or kb < ka:
+            yield b[0], None, b
+            b, kb = advance(right, kb)
+        else:
+            yield a[0], a, b
+            a, ka = advance(left, ka)
+            b, kb = advance(right, kb)
+
+
+# ----------------------------------------------------------------------
+# batch lookup: 按 id 和 word 分组，每组切块后用 IN (...) 查询，
+# 块大小低于 SQLITE_MAX_VARIABLE_NUMBER 的最小默认值 999
+# ----------------------------------------------------------------------
+BATCH_CHUNK = 500
+
+def batch_lookup(keys, fetch, chunk=BATCH_CHUNK):
+    if keys is None:
+        return None
+    if not keys:
+        return []
+    ids = {}
+    words = {}
+    for key in keys:
+        if isinstance(key, int) or isinstance(key, long):
+            ids[key] = 1
+        elif key is not None:
+            words[key] = 1
+    query_id = {}
+    query_word = {}
+    for name, keyset in (('id', ids), ('word', words)):
+        keyset = list(keyset.keys())
+        for pos in xrange(0, len(keyset), chunk):
+            for obj in fetch(name, keyset[pos:pos + chunk]):
+                query_word[obj['word'].lower()] = obj
+                query_id[obj['id']] = obj
+    results = []
+    for key in keys:
+        if isinstance(key, int) or isinstance(key, long):
+            results.append(query_id.get(key, None))
+        elif key is not None:
+            results.append(query_word.get(key.lower(), None))
+        else:
+            results.append(None)
+    return tuple(results)
+
+
+# ----------------------------------------------------------------------
+# CJK grams: 中文没有分词，反查时用相邻两个汉字作为索引词；建索引时
+# 每段汉字的最后一个字再单独记一次，单字查询用前缀范围扫描即可
+# ----------------------------------------------------------------------
+CJK_PATTERN = re.compile(u'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+
+def cjk_grams(text, query=False):
+    grams = {}
+    if not text:
+        return []
+    for run in CJK_PATTERN.findall(text):
+        for i in xrange(len(run) - 1):
+            grams[run[i:i + 2]] = 1
+        if (not query) or len(run) == 1:
+            grams[run[-1]] = 1
+    return list(grams.keys())
+
+
+# ----------------------------------------------------------------------
+# word score: 用于排序的常用度，取当代语料库和 BNC 词频排名中较小的
+# 那个，越小越常用；都没有时排在所有有词频的单词后面，柯林斯星级高的
+# 靠前。WORD_SCORE_SQL 是同样算法的 SQL 表达式
+# ----------------------------------------------------------------------
+WORD_SCORE_MAX = 100000000
+
+WORD_SCORE_SQL = '''(CASE WHEN frq > 0 AND (bnc IS NULL OR bnc <= 0 OR
+	frq <= bnc) THEN frq WHEN bnc > 0 THEN bnc
+	ELSE %d - ifnull(collins, 0) END)''' % WORD_SCORE_MAX
+
+def word_score(frq, bnc, collins):
+    ranks = [n for n in (frq, bnc) if n and n > 0]
+    if ranks:
+        return min(ranks)
+    return WORD_SCORE_MAX - (collins or 0)
+
+# 结果排序的 SQL：frq/bnc 排名越小越靠前，没有排名的放在最后，
+# collins/oxford 越大越靠前，score 为上面的综合常用度
+def word_order(order_by):
+    if order_by in ('frq', 'bnc'):
+        return '(%s is null or %s <= 0), %s' % (order_by, order_by, order_by)
+    if order_by in ('collins', 'oxford'):
+        return '%s desc' % order_by
+    if order_by == 'word':
+        return 'word collate nocase'
+    if order_by == 'score':
+        return WORD_SCORE_SQL
+    raise KeyError('unknown order: %s' % order_by)
+
+
+# ----------------------------------------------------------------------
+# field projection: 只查询需要的字段，id 和 word 总是包含在内，
+# 返回 (select 用的列名列表, 记录布局)，记录布局为 (字段名元组, 下标字典)
+# ----------------------------------------------------------------------
+FIELDS = ('id', 'word', 'sw', 'phonetic', 'definition', 'translation',
+          'pos', 'collins', 'oxford', 'tag', 'bnc', 'frq', 'exchange',
+          'detail', 'audio')
+
+def field_projection(fields=None):
+    if fields is None:
+        names = FIELDS
+    else:
+        for name in fields:
+            if name not in FIELDS:
+                raise KeyError('unknown field: %s' % name)
+        names = [n for n in FIELDS if n in fields or n in ('id', 'word')]
+    names = tuple(names)
+    index = dict([(names[i], i) for i in range(len(names))])
+    return ', '.join(names), (names, index)
+
+
+# ----------------------------------------------------------------------
+# DictRecord: 紧凑的词条记录，同一种投影的记录共享一份布局，字段值
+# 直接引用数据库返回的元组，detail 第一次访问时才做 json 解码，
+# 支持 record['word'], get, keys, items 等字典的读写方式
+# ----------------------------------------------------------------------
+_LAZY = object()
+
+class DictRecord(object):
+    __slots__ = ('_layout', '_values', '_detail', '_extra')
+
+    def __init__(self, layout, values, detail=_LAZY):
+        self._layout = layout
+        self._values = values
+        self._detail = detail
+        self._extra = None
+
+    def __getitem__(self, key):
+        pos = self._layout[1].get(key, None)
+        if pos is not None:
+            if key == 'detail':
+                return self.__detail(pos)
+            return self._values[pos]
+        if self._extra is not None:
+            if key in self._extra:
+                return self._extra[key]
+        raise KeyError(key)
+
+    def __detail(self, pos):
+        detail = self._detail
+        if detail is _LAZY:
+            text = self._values[pos]
+            detail = None
+            if text:
+                try:
+                    detail = json.loads(text)
+                except:
+                    detail = None
+            self._detail = detail
+        return detail
+
+    def __setitem__(self, key, value):
+        pos = self._layout[1].get(key, None)
+        if pos is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        elif key == 'detail':
+            self._detail = value
+        else:
+            if not isinstance(self._values, list):
+                self._values = list(self._values)
+            self._values[pos] = value
+
+    def __contains__(self, key):
+        if key in self._layout[1]:
+            return True
+        return (self._extra is not None) and (key in self._extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        size = len(self._layout[0])
+        if self._extra is not None:
+            size += len(self._extra)
+        return size
+
+    def __eq__(self, other):
+        if isinstance(other, DictRecord):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        names = list(self._layout[0])
+        if self._extra is not None:
+            names.extend(self._extra.keys())
+        return names
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    # 浅拷贝，已经解码的 detail 会共享
+    def copy(self):
+        record = DictRecord(self._layout, self._values, self._detail)
+        if isinstance(self._values, list):
+            record._values = list(self._values)
+        if self._extra is not None:
+            record._extra = dict(self._extra)
+        return record
+
+    # 转换为普通字典
+    def to_dict(self):
+        return dict(self.items())
+
+
+# ----------------------------------------------------------------------
+# batch records: 把 (word, items) 序列按出现的字段组合分组，每组
+# 生成 (names, rows)，rows 里每一行为 (word, sw, value1, value2, ...)
+# ----------------------------------------------------------------------
+BATCH_ROWS = 1000
+
+def batch_records(records, names, size=BATCH_ROWS):
+    current = None
+    rows = []
+    for word, items in records:
+        keys = tuple([n for n in names if n in items])
+        if keys != current:
+            if rows:
+                yield current, rows
+            current = keys
+            rows = []
+        values = [word, stripword(word)]
+        for name in keys:
+            value = items[name]
+            if name == 'detail':
+                if value is not None:
+                    value = json.dumps(value, ensure_ascii=False)
+            values.append(value)
+        rows.append(tuple(values))
+        if len(rows) >= size:
+            yield current, rows
+            rows = []
+    if rows:
+        yield current, rows
+
+
+# 批量写入的统计结果：处理行数，实际改动行数，耗时和每秒行数
+def batch_report(count, changes, ts):
+    ts = max(time.time() - ts, 0.000001)
+    return {'rows': count, 'changes': changes, 'seconds': ts,
+            'rate': count / ts}
+
+
+# ----------------------------------------------------------------------
+# derived columns: 由词条其它字段计算出来的列，只在 StarDict 里保存，
+# 用来建立索引。每项为 (列名, 依赖的字段, 计算函数)，写入时只要依赖
+# 的字段都已知就一并计算，老版本数据库打开时自动补上并回填
+# ----------------------------------------------------------------------
+
+# 字母签名：sw 的字母排序，互为变位词（anagram）的单词签名相同
+def word_signature(sw):
+    return ''.join(sorted(sw or ''))
+
+# 读音键：简化的 Metaphone，把拼写映射成大致的发音，读音相近的单词
+# 键相同。0 表示 th，X 表示 sh/ch
+def metaphone(word):
+    w = ''.join([c for c in (word or '').lower() if 'a' <= c <= 'z'])
+    if not w:
+        return ''
+    if w[:2] in ('ae', 'gn', 'kn', 'pn', 'wr'):
+        w = w[1:]
+    elif w[:1] == 'x':
+        w = 's' + w[1:]
+    elif w[:2] == 'wh':
+        w = 'w' + w[2:]
+    vowels = 'aeiou'
+    size = len(w)
+    text = ' ' + w + '  '
+    output = []
+    for i in xrange(1, size + 1):
+        c = text[i]
+        prev = text[i - 1]
+        next = text[i + 1]
+        after = text[i + 2]
+        if c == prev and c != 'c':
+            continue
+        if c in vowels:
+            if i == 1:
+                output.append(c.upper())
+        elif c == 'b':
+            if not (prev == 'm' and i == size):
+                output.append('B')
+        elif c == 'c':
+            if next == 'i' and after == 'a':
+                output.append('X')
+            elif next == 'h':
+                output.append((prev == 's') and 'K' or 'X')
+            elif next in ('i', 'e', 'y'):
+                if prev != 's':
+                    output.append('S')
+            else:
+                output.append('K')
+        elif c == 'd':
+            if next == 'g' and after in ('e', 'i', 'y'):
+                output.append('J')
+            else:
+                output.append('T')
+        elif c == 'g':
+            if next == 'h' and after not in vowels:
+                continue
+            if next == 'n' and (i + 1 == size or w[i + 1:] == 'ed'):
+                continue
+            if prev == 'd' and next in ('e', 'i', 'y'):
+                continue
+            if next in ('e', 'i', 'y') and prev != 'g':
+                output.append('J')
+            else:
+                output.append('K')
+        elif c == 'h':
+            if prev in ('c', 'g', 'p', 's', 't'):
+                continue
+            if next in vowels:
+                output.append('H')
+        elif c == 'k':
+            if prev != 'c':
+                output.append('K')
+        elif c == 'p':
+            output.append((next == 'h') and 'F' or 'P')
+        elif c == 'q':
+            output.append('K')
+        elif c == 's':
+            if next == 'h' or (next == 'i' and after in ('o', 'a')):
+                output.append('X')
+            else:
+                output.append('S')
+        elif c == 't':
+            if next == 'i' and after in ('o', 'a'):
+                output.append('X')
+            elif next == 'h':
+                output.append('0')
+            elif not (next == 'c' and after == 'h'):
+                output.append('T')
+        elif c == 'v':
+            output.append('F')
+        elif c in ('w', 'y'):
+            if next in vowels:
+                output.append(c.upper())
+        elif c == 'x':
+            output.append('KS')
+        elif c == 'z':
+            output.append('S')
+        else:
+            output.append(c.upper())
+    return ''.join(output)
+
+# 反转的 sw，词尾相同的单词在索引里是连续的
+def word_reverse(sw):
+    return (sw or '')[::-1]
+
+# 韵脚：音标里最后一个主重音（ˈ 或者 '）后面的第一个元音到结尾的
+# 部分，没有重音符号时取最后一个元音（包括双元音和长音符）到结尾
+RHYME_VOWELS = u'aeiouyæɑɒɔəɚɛɜɝɪʊʌː:'
+RHYME_STRESS = u'ˈ\''
+
+def rhyme_key(phonetic):
+    text = ''.join([c for c in (phonetic or '') if c not in u'ˌ/[]() .-'])
+    stress = max([text.rfind(c) for c in RHYME_STRESS])
+    if stress >= 0:
+        tail = text[stress + 1:]
+        pos = 0
+        while pos < len(tail) and tail[pos] not in RHYME_VOWELS:
+            pos += 1
+        if pos < len(tail):
+            return tail[pos:].replace(':', u'ː')
+    text = ''.join([c for c in text if c not in RHYME_STRESS])
+    pos = len(text) - 1
+    while pos >= 0 and text[pos] not in RHYME_VOWELS:
+        pos -= 1
+    if pos < 0:
+        return None
+    while pos > 0 and text[pos - 1] in RHYME_VOWELS:
+        pos -= 1
+    return text[pos:].replace(':', u'ː')
+
+# 考试标签位图：tag 字段里的标签按 TAG_NAMES 的顺序对应一个二进制位
+TAG_NAMES = ('zk', 'gk', 'ky', 'cet4', 'cet6', 'toefl', 'ielts', 'gre')
+
+def tag_mask(tag):
+    mask = 0
+    for name in (tag or '').split():
+        if name in TAG_NAMES:
+            mask |= 1 << TAG_NAMES.index(name)
+    return mask
+
+DERIVED_COLUMNS = (
+    ('sig', ('sw',), word_signature),
+    ('sound', ('sw',), metaphone),
+    ('rsw', ('sw',), word_reverse),
+    ('rhyme', ('phonetic',), rhyme_key),
+    ('tagmask', ('tag',), tag_mask),
+)
+
+# values 为已知字段的字典，返回可以计算的派生列 [(列名, 值), ...]
+def derived_values(values):
+    output = []
+    for name, depends, compute in DERIVED_COLUMNS:
+        if not [n for n in depends if n not in values]:
+            output.append((name, compute(*[values[n] for n in depends])))
+    return output
+
+# sqlite_master 里建表语句的对象类型：'index' 或者 'trigger'
+def schema_kind(sql):
+    words = sql.split(None, 3)[:3]
+    return ('TRIGGER' in [n.upper() for n in words]) and 'trigger' or 'index'
+
 
 # ----------------------------------------------------------------------
 # StarDict 
 # ----------------------------------------------------------------------
+# 数据库结构版本号，保存在 PRAGMA user_version 里，相同时跳过建表语句
+STARDICT_VERSION = 7
+
+# 计算方法改变过的派生列和改变时的版本号，老版本数据库升级时重新计算
+DERIVED_VERSIONS = {'rhyme': 6}
+
+# 默认内存映射大小（字节）和页缓存大小（KB）
+STARDICT_MMAP_SIZE = 256 * 1024 * 1024
+STARDICT_CACHE_SIZE = 16 * 1024
+
+# 等待数据库锁的默认超时（秒）
+STARDICT_TIMEOUT = 5.0
+
+# PRAGMA synchronous 可选的级别
+STARDICT_SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# 前缀补全表保存的最大前缀长度，和每个前缀保存的单词数量
+AUTOCOMPLETE_DEPTH = 8
+AUTOCOMPLETE_SIZE = 10
+
+# 通配符索引除了每个字母的正向位置，还保存最后几个字母的反向位置
+PATTERN_TAIL = 4
+
+# 子变位词查询最多枚举的签名数量，超过时改为扫描签名列
+SUBANAGRAM_SIGNATURES = 65536
+
+# 批量导入模式每个事务写入的行数
+BULK_ROWS = 50000
+
+# 批量导入把删除的索引和触发器记在 stardict_resume 表里的名字
+STARDICT_RESUME_INDEXES = 'bulk:indexes'
+
+# 拼写建议的最大编辑距离，和生成删除变体时使用的前缀长度
+SPELL_DISTANCE = 2
+SPELL_PREFIX = 7
+
+
 class StarDict(object):
-    def __init__(self, filename, verbose=False):
+    def __init__(self, filename, verbose=False, readonly=False,
+                 immutable=False, mmap_size=None, cache_size=None,
+                 wal=False, synchronous=None, autocheckpoint=None,
+                 timeout=None, check_same_thread=True):
         self.__dbname = os.path.abspath(filename)
         self.__conn = None
+        self.__spell = None
+        self.__bulk = False
         self.__verbose = verbose
+        self.__readonly = readonly
+        self.__immutable = immutable
+        if mmap_size is None:
+            mmap_size = STARDICT_MMAP_SIZE
+        if cache_size is None:
+            cache_size = STARDICT_CACHE_SIZE
+        self.__mmap_size = mmap_size
+        self.__cache_size = cache_size
+        if synchronous is None and wal:
+            synchronous = 'NORMAL'
+        if synchronous is not None:
+            synchronous = str(synchronous).upper()
+            if synchronous not in STARDICT_SYNCHRONOUS:
+                raise ValueError('bad synchronous level: %s' % synchronous)
+        if timeout is None:
+            timeout = STARDICT_TIMEOUT
+        self.__wal = wal
+        self.__synchronous = synchronous
+        self.__autocheckpoint = autocheckpoint
+        self.__timeout = timeout
+        self.__check_same_thread = check_same_thread
         self.__open()
 
     # 初始化并创建必要的表格和索引
@@ -67,22 +599,58 @@ class StarDict(object):
 			"frq" INTEGER DEFAULT(NULL),
 			"exchange" TEXT,
 			"detail" TEXT,
-			"audio" TEXT
+			"audio" TEXT,
+			"sig" VARCHAR(64),
+			"sound" VARCHAR(64),
+			"rsw" VARCHAR(64),
+			"rhyme" VARCHAR(16),
+			"tagmask" INTEGER DEFAULT(0)
 		);
 		CREATE UNIQUE INDEX IF NOT EXISTS "stardict_1" ON stardict (id);
 		CREATE UNIQUE INDEX IF NOT EXISTS "stardict_2" ON stardict (word);
 		CREATE INDEX IF NOT EXISTS "stardict_3" ON stardict (sw, word collate nocase);
 		CREATE INDEX IF NOT EXISTS "sd_1" ON stardict (word collate nocase);
+		CREATE TABLE IF NOT EXISTS "stardict_change" ("serial" INTEGER NOT NULL);
+		INSERT INTO stardict_change SELECT 0
+			WHERE NOT EXISTS (SELECT 1 FROM stardict_change);
+		CREATE TRIGGER IF NOT EXISTS "stardict_change_ai" AFTER INSERT ON stardict
+			BEGIN UPDATE stardict_change SET serial = serial + 1; END;
+		CREATE TRIGGER IF NOT EXISTS "stardict_change_ad" AFTER DELETE ON stardict
+			BEGIN UPDATE stardict_change SET serial = serial + 1; END;
+		CREATE TRIGGER IF NOT EXISTS "stardict_change_au"
+			AFTER UPDATE OF word, frq, bnc, collins ON stardict
+			BEGIN UPDATE stardict_change SET serial = serial + 1; END;
+		'''
+        sql2 = '''
+		CREATE INDEX IF NOT EXISTS "stardict_4" ON stardict (sig);
+		CREATE INDEX IF NOT EXISTS "stardict_5" ON stardict (sound);
+		CREATE INDEX IF NOT EXISTS "stardict_6" ON stardict (rsw, word collate nocase);
+		CREATE INDEX IF NOT EXISTS "stardict_7" ON stardict (rhyme);
+		CREATE INDEX IF NOT EXISTS "stardict_8" ON stardict (tagmask, frq);
 		'''
 
-        self.__conn = sqlite3.connect(self.__dbname, isolation_level="IMMEDIATE")
-        self.__conn.isolation_level = "IMMEDIATE"
-
-        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
-        sql = sql.strip('\n')
-
-        self.__conn.executescript(sql)
-        self.__conn.commit()
+        if self.__readonly:
+            self.__conn = self.__connect_readonly()
+        else:
+            self.__conn = sqlite3.connect(self.__dbname, isolation_level="IMMEDIATE",
+                                          timeout=self.__timeout,
+                                          check_same_thread=self.__check_same_thread)
+            self.__conn.isolation_level = "IMMEDIATE"
+
+        self.__pragma()
+        self.__journal()
+
+        if not self.__readonly:
+            version = self.__version()
+            if version != STARDICT_VERSION:
+                sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
+                sql = sql.strip('\n')
+                self.__conn.executescript(sql)
+                self.__upgrade(version)
+                sql2 = '\n'.join([n.strip('\t') for n in sql2.split('\n')])
+                self.__conn.executescript(sql2.strip('\n'))
+                self.__conn.execute('PRAGMA user_version = %d;' % STARDICT_VERSION)
+                self.__conn.commit()
 
         fields = ('id', 'word', 'sw', 'phonetic', 'definition',
                   'translation', 'pos', 'collins', 'oxford', 'tag', 'bnc', 'frq',
@@ -92,29 +660,144 @@ class StarDict(object):
         for k, v in self.__fields:
             self.__names[k] = v
         self.__enable = self.__fields[3:]
+        self.__projects = {}
+        self.__cjk = self.__exists('stardict_cjk')
+        self.__prefix = self.__exists('stardict_prefix')
+        self.__pattern = self.__exists('stardict_pattern')
+        if not self.__readonly:
+            self.__bulk_recover()
+        return True
+
+    # 老版本数据库缺少的派生列：添加并根据依赖的字段回填，计算方法
+    # 在 version 以后改变过的派生列重新计算
+    def __upgrade(self, version):
+        c = self.__conn.cursor()
+        c.execute('PRAGMA table_info(stardict);')
+        columns = [row[1] for row in c.fetchall()]
+        for name, depends, compute in DERIVED_COLUMNS:
+            if name not in columns:
+                self.out('upgrade: add column %s' % name)
+                c.execute('ALTER TABLE stardict ADD COLUMN "%s";' % name)
+            elif version < DERIVED_VERSIONS.get(name, 0):
+                self.out('upgrade: recompute column %s' % name)
+            else:
+                continue
+            reader = self.__conn.cursor()
+            reader.execute('select id, %s from stardict;' % ', '.join(depends))
+            sql = 'UPDATE stardict SET %s=? WHERE id=?;' % name
+            while True:
+                rows = reader.fetchmany(BATCH_ROWS)
+                if not rows:
+                    break
+                c.executemany(sql, [(compute(*row[1:]), row[0]) for row in rows])
+        self.__conn.commit()
+        return True
+
+    # 只读方式打开：mode=ro 不会去抢写锁，immutable=1 连共享锁都省掉。
+    # immutable=1 时 SQLite 假定文件永远不变，不加锁也不检查改动，其它
+    # 进程写入或者替换文件以后，这个连接可能读到旧的缓存页甚至损坏的
+    # 数据，所以默认关闭，只有确定不会再改的静态词典文件才打开
+    def __connect_readonly(self):
+        if not os.path.exists(self.__dbname):
+            raise IOError('can not open %s' % self.__dbname)
+        if sys.version_info[0] < 3:
+            conn = sqlite3.connect(self.__dbname, isolation_level=None,
+                                   timeout=self.__timeout,
+                                   check_same_thread=self.__check_same_thread)
+            conn.execute('PRAGMA query_only = 1;')
+            return conn
+        try:
+            from urllib.request import pathname2url
+        except ImportError:
+            from urllib import pathname2url
+        uri = 'file:' + pathname2url(self.__dbname) + '?mode=ro'
+        if self.__immutable:
+            uri += '&immutable=1'
+        return sqlite3.connect(uri, uri=True, isolation_level=None,
+                               timeout=self.__timeout,
+                               check_same_thread=self.__check_same_thread)
+
+    # 设置内存映射和页缓存，查询直接从系统页缓存里读数据页
+    def __pragma(self):
+        c = self.__conn
+        if self.__mmap_size is not None and self.__mmap_size >= 0:
+            c.execute('PRAGMA mmap_size = %d;' % self.__mmap_size)
+        if self.__cache_size:
+            c.execute('PRAGMA cache_size = -%d;' % self.__cache_size)
+        c.execute('PRAGMA busy_timeout = %d;' % int(self.__timeout * 1000))
+        return True
+
+    # 日志模式：WAL 下读者读取快照，不会被正在提交的写者阻塞
+    def __journal(self):
+        if self.__readonly:
+            return False
+        c = self.__conn
+        if self.__wal:
+            c.execute('PRAGMA journal_mode = WAL;')
+            if self.__autocheckpoint is not None:
+                n = int(self.__autocheckpoint)
+                c.execute('PRAGMA wal_autocheckpoint = %d;' % n)
+        if self.__synchronous is not None:
+            c.execute('PRAGMA synchronous = %s;' % self.__synchronous)
         return True
 
-    # 数据库记录转化为字典
-    def __record2obj(self, record):
+    # 手动检查点，mode 为 PASSIVE/FULL/RESTART/TRUNCATE
+    def checkpoint(self, mode='PASSIVE'):
+        mode = mode.upper()
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError('bad checkpoint mode: %s' % mode)
+        c = self.__conn.cursor()
+        try:
+            c.execute('PRAGMA wal_checkpoint(%s);' % mode)
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return None
+        return tuple(c.fetchone())
+
+    # 当前日志模式
+    def journal_mode(self):
+        c = self.__conn.cursor()
+        c.execute('PRAGMA journal_mode;')
+        return c.fetchone()[0].lower()
+
+    # 取得数据库结构版本
+    def __version(self):
+        c = self.__conn.cursor()
+        c.execute('PRAGMA user_version;')
+        record = c.fetchone()
+        return record[0]
+
+    # 是否以只读方式打开
+    def readonly(self):
+        return self.__readonly
+
+    # 字段投影，结果缓存起来，返回 (select 列名, 记录布局)
+    def __projection(self, fields):
+        key = None
+        if fields is not None:
+            key = tuple(fields)
+        proj = self.__projects.get(key, None)
+        if proj is None:
+            proj = field_projection(fields)
+            self.__projects[key] = proj
+        return proj
+
+    # 数据库记录转化为 DictRecord
+    def __record2obj(self, record, layout=None):
         if record is None:
             return None
-        word = {}
-        for k, v in self.__fields:
-            word[k] = record[v]
-        if word['detail']:
-            text = word['detail']
-            try:
-                obj = json.loads(text)
-            except:
-                obj = None
-            word['detail'] = obj
-        return word
+        if layout is None:
+            layout = self.__projection(None)[1]
+        return DictRecord(layout, record)
 
     # 关闭数据库
     def close(self):
         if self.__conn:
             self.__conn.close()
         self.__conn = None
+        if self.__spell:
+            self.__spell.close()
+        self.__spell = None
 
     def __del__(self):
         self.close()
@@ -125,18 +808,20 @@ class StarDict(object):
             print(text)
         return True
 
-    # 查询单词
-    def query(self, key):
+    # 查询单词，fields 指定只取哪些字段（id 和 word 总会返回）
+    def query(self, key, fields=None):
+        select, layout = self.__projection(fields)
         c = self.__conn.cursor()
         record = None
         if isinstance(key, int) or isinstance(key, long):
-            c.execute('select * from stardict where id = ?;', (key,))
+            sql = 'select %s from stardict where id = ?;' % select
         elif isinstance(key, str) or isinstance(key, unicode):
-            c.execute('select * from stardict where word = ?', (key,))
+            sql = 'select %s from stardict where word = ?;' % select
         else:
             return None
+        c.execute(sql, (key,))
         record = c.fetchone()
-        return self.__record2obj(record)
+        return self.__record2obj(record, layout)
 
     # 查询单词匹配
     def match(self, word, limit=10, strip=False):
@@ -155,37 +840,30 @@ class StarDict(object):
             result.append(tuple(record))
         return result
 
-    # 批量查询
-    def query_batch(self, keys):
-        sql = 'select * from stardict where '
-        if keys is None:
-            return None
-        if not keys:
-            return []
-        querys = []
-        for key in keys:
-            if isinstance(key, int) or isinstance(key, long):
-                querys.append('id = ?')
-            elif key is not None:
-                querys.append('word = ?')
-        sql = sql + ' or '.join(querys) + ';'
-        query_word = {}
-        query_id = {}
+    # 查询单词匹配，直接返回匹配到的记录
+    def match_rows(self, word, limit=10, strip=False, fields=None):
+        select, layout = self.__projection(fields)
         c = self.__conn.cursor()
-        c.execute(sql, tuple(keys))
-        for row in c:
-            obj = self.__record2obj(row)
-            query_word[obj['word'].lower()] = obj
-            query_id[obj['id']] = obj
-        results = []
-        for key in keys:
-            if isinstance(key, int) or isinstance(key, long):
-                results.append(query_id.get(key, None))
-            elif key is not None:
-                results.append(query_word.get(key.lower(), None))
-            else:
-                results.append(None)
-        return tuple(results)
+        if not strip:
+            sql = 'select %s from stardict where word >= ? ' % select
+            sql += 'order by word collate nocase limit ?;'
+            c.execute(sql, (word, limit))
+        else:
+            sql = 'select %s from stardict where sw >= ? ' % select
+            sql += 'order by sw, word collate nocase limit ?;'
+            c.execute(sql, (stripword(word), limit))
+        return [self.__record2obj(record, layout) for record in c]
+
+    # 批量查询
+    def query_batch(self, keys, fields=None):
+        select, layout = self.__projection(fields)
+        def fetch(name, chunk):
+            sql = 'select %s from stardict where %s in (%s);'
+            sql = sql % (select, name, ','.join(['?'] * len(chunk)))
+            c = self.__conn.cursor()
+            c.execute(sql, tuple(chunk))
+            return [self.__record2obj(row, layout) for row in c]
+        return batch_lookup(keys, fetch)
 
     # 取得单词总数
     def count(self):
@@ -196,18 +874,541 @@ class StarDict(object):
 
     # 注册新单词
     def register(self, word, items, commit=True):
-        sql = 'INSERT INTO stardict(word, sw) VALUES(?, ?);';
+        sw = stripword(word)
+        derived = derived_values({'word': word, 'sw': sw})
+        cols = ['word', 'sw'] + [n for n, _ in derived]
+        sql = 'INSERT INTO stardict(%s) VALUES(%s);' % \
+              (', '.join(cols), ', '.join(['?'] * len(cols)))
         try:
-            self.__conn.execute(sql, (word, stripword(word)))
+            self.__conn.execute(sql, tuple([word, sw] + [v for _, v in derived]))
         except sqlite3.IntegrityError as e:
             self.out(str(e))
             return False
         except sqlite3.Error as e:
             self.out(str(e))
             return False
-        self.update(word, items, commit)
+        self.__update(word, items, commit, ('word',))
+        return True
+
+    # 批量注册新单词，已经存在的跳过，整批在一个事务里完成
+    def register_many(self, records, commit=True):
+        return self.__write_many(records, False, commit)
+
+    # 批量写入：不存在的注册，存在的更新 items 里给出的字段
+    def upsert_many(self, records, commit=True):
+        return self.__write_many(records, True, commit)
+
+    def __write_many(self, records, upsert, commit):
+        ts = time.time()
+        names = [n for n, _ in self.__enable]
+        native = (sqlite3.sqlite_version_info >= (3, 24, 0))
+        count = 0
+        changes = 0
+        c = self.__conn.cursor()
+        try:
+            for keys, rows in batch_records(records, names):
+                # 派生列附加在每一行的末尾，word 和 sw 总是已知的
+                known = ('word', 'sw') + keys
+                extra = []
+                for name, depends, compute in DERIVED_COLUMNS:
+                    if not [n for n in depends if n not in known]:
+                        pos = [known.index(n) for n in depends]
+                        extra.append((name, compute, pos))
+                if extra:
+                    rows = [r + tuple([f(*[r[i] for i in p]) for _, f, p in extra])
+                            for r in rows]
+                # 只依赖 word 和 sw 的派生列和单词一样，冲突时不需要更新
+                update = keys + tuple([n for n, f, p in extra
+                                       if [i for i in p if i >= 2]])
+                cols = known + tuple([n for n, _, _ in extra])
+                sql = 'INSERT INTO stardict(%s) VALUES(%s)' % \
+                      (', '.join(cols), ', '.join(['?'] * len(cols)))
+                sets = ', '.join(['%s=excluded.%s' % (n, n) for n in update])
+                if not native:
+                    # 老版本 SQLite 没有 UPSERT，先更新已有的再插入新的
+                    if upsert and update:
+                        sql2 = 'UPDATE stardict SET '
+                        sql2 += ', '.join(['%s=?' % n for n in update])
+                        sql2 += ' WHERE word=?;'
+                        index = [cols.index(n) for n in update]
+                        c.executemany(sql2, [tuple([r[i] for i in index]) + r[:1]
+                                             for r in rows])
+                        changes += c.rowcount
+                    sql = sql.replace('INSERT', 'INSERT OR IGNORE', 1)
+                elif upsert and update:
+                    sql += ' ON CONFLICT(word) DO UPDATE SET ' + sets
+                else:
+                    sql += ' ON CONFLICT(word) DO NOTHING'
+                c.executemany(sql + ';', rows)
+                changes += c.rowcount
+                count += len(rows)
+                self.__derive([row[0] for row in rows], ('word',) + keys)
+            if commit:
+                self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            self.__conn.rollback()
+            return None
+        return batch_report(count, changes, ts)
+
+    # 批量导入模式：先删除二级索引和触发器，日志放在内存里，关闭同步
+    # 写盘，每 size 行一个事务用 executemany 写入，完成后重建索引并
+    # ANALYZE，反查索引等派生数据最后整体重建。中途断电数据库可能损坏，
+    # 只适合从头生成数据库。实测（test19，20 万行）逐个 register 13.1 秒，bulk_load
+    # 3.9 秒，约 3.3 倍；剩下的时间主要是逐行在 Python 里整理字段和计算
+    # sig/sound/rhyme 等派生列。派生列改成导入以后再 UPDATE 回填要把每
+    # 一行重写一遍，整体反而更慢，所以仍然在写入时计算。
+    # records 为 (word, items) 序列，已经存在的单词跳过，返回统计结果。
+    # resume 不为 None 时保留日志，每个事务同时把最后一个单词作为进度
+    # 标记写入 stardict_resume 表，中断以后可以从标记继续，完成后清除
+    def bulk_load(self, records, size=BULK_ROWS, resume=None):
+        ts = time.time()
+        state = self.__bulk_begin(resume is not None)
+        if state is None:
+            return None
+        count = 0
+        changes = 0
+        failed = False
+        try:
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) < size:
+                    continue
+                hr = self.__bulk_write(chunk, resume)
+                chunk = []
+                if hr is None:
+                    failed = True
+                    break
+                count += hr['rows']
+                changes += hr['changes']
+                self.out('bulk: %d rows, %.1f rows/sec' % \
+                         (count, count / max(time.time() - ts, 0.000001)))
+            if chunk and not failed:
+                hr = self.__bulk_write(chunk, resume)
+                if hr is None:
+                    failed = True
+                else:
+                    count += hr['rows']
+                    changes += hr['changes']
+        finally:
+            index = self.__bulk_end(state)
+        if failed:
+            return None
+        if resume is not None:
+            self.resume_clear(resume)
+        hr = batch_report(count, changes, ts)
+        hr['index'] = index
+        self.out('bulk: %d rows in %.2f seconds (index %.2f), %.1f rows/sec' % \
+                 (count, hr['seconds'], hr['index'], hr['rate']))
+        return hr
+
+    # 写入一批，有进度标记时和标记在同一个事务里提交
+    def __bulk_write(self, chunk, resume):
+        if resume is None:
+            return self.__write_many(chunk, False, True)
+        hr = self.__write_many(chunk, False, False)
+        if hr is not None:
+            try:
+                self.resume_set(resume, chunk[-1][0], True)
+            except sqlite3.Error as e:
+                self.out(str(e))
+                self.__conn.rollback()
+                return None
+        return hr
+
+    # 并行导入 DictCsv 格式的 csv 文件：按行边界把文件切成若干块，由
+    # workers 个进程解析（包括计算 sw 和派生列），主进程按块的顺序去重，
+    # 同一个单词（忽略大小写）只保留第一次出现的，先写入暂存表
+    # stardict_import，全部读完以后再按单词顺序一次插入 stardict，这样
+    # id 连续并且和 DictCsv 读取时的顺序相同。workers 为 None 时使用全部
+    # CPU，为 1 时不启动进程池。同时在途的块不超过 workers * 2 个。
+    # resume 不为 None 时进度标记为已经写入暂存表的块结束位置，续传时
+    # 直接从该位置开始切块
+    # 只有解析是并行的：单进程导入 5 万行时解析约占 65%，去重、写入
+    # 暂存表、按单词顺序插入和重建索引都在主进程里，核再多也最多快
+    # 3 倍左右，多核上的实际加速比没有测过
+    def bulk_import(self, csvname, workers=None, codec='utf-8',
+                    size=BULK_ROWS, resume=None):
+        ts = time.time()
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        start = 0
+        if resume is not None:
+            start = int(self.resume_get(resume) or 0)
+        tasks = [(csvname, begin, end, codec)
+                 for begin, end in csv_split(csvname, start=start)]
+        state = self.__bulk_begin(resume is not None)
+        if state is None:
+            return None
+        names, _ = csv_import_columns()
+        fields = ', '.join(names)
+        sql = 'INSERT INTO stardict_import(%s) VALUES(%s);' % \
+              (fields, ', '.join(['?'] * len(names)))
+        pool = None
+        count = 0
+        changes = 0
+        failed = False
+        c = self.__conn.cursor()
+        seen = set()
+        try:
+            if start == 0:
+                c.execute('DROP TABLE IF EXISTS stardict_import;')
+            c.execute('CREATE TABLE IF NOT EXISTS stardict_import (%s);' % fields)
+            self.__conn.commit()
+            c.execute('select word from stardict_import;')
+            for record in c.fetchall():
+                seen.add(record[0].lower())
+        except sqlite3.Error as e:
+            self.out(str(e))
+            self.__bulk_end(state)
+            return None
+        try:
+            if workers > 1:
+                import multiprocessing
+                pool = multiprocessing.Pool(workers)
+            pending = collections.deque()
+            position = 0
+            rows = []
+            while True:
+                while position < len(tasks) and len(pending) < workers * 2:
+                    task = tasks[position]
+                    position += 1
+                    if pool is None:
+                        result = csv_import_chunk(task)
+                    else:
+                        result = pool.apply_async(csv_import_chunk, (task,))
+                    pending.append((task[2], result))
+                if not pending:
+                    break
+                end, result = pending.popleft()
+                if pool is not None:
+                    result = result.get()
+                for row in result:
+                    key = row[0].lower()
+                    if key not in seen:
+                        seen.add(key)
+                        rows.append(row)
+                if len(rows) < size and (position < len(tasks) or pending):
+                    continue
+                try:
+                    c.executemany(sql, rows)
+                    if resume is not None:
+                        self.resume_set(resume, str(end), False)
+                    self.__conn.commit()
+                except sqlite3.Error as e:
+                    self.out(str(e))
+                    self.__conn.rollback()
+                    failed = True
+                    break
+                count += len(rows)
+                rows = []
+                self.out('bulk: %d rows, %.1f rows/sec' % \
+                         (count, count / max(time.time() - ts, 0.000001)))
+            if not failed:
+                try:
+                    c.execute('INSERT OR IGNORE INTO stardict(%s) SELECT %s ' \
+                              'FROM stardict_import ORDER BY word COLLATE NOCASE;' \
+                              % (fields, fields))
+                    changes = c.rowcount
+                    c.execute('DROP TABLE stardict_import;')
+                    self.__conn.commit()
+                except sqlite3.Error as e:
+                    self.out(str(e))
+                    self.__conn.rollback()
+                    failed = True
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            index = self.__bulk_end(state)
+        if failed:
+            return None
+        if resume is not None:
+            self.resume_clear(resume)
+        hr = batch_report(count, changes, ts)
+        hr['index'] = index
+        self.out('import: %d rows in %.2f seconds (index %.2f), %.1f rows/sec' % \
+                 (count, hr['seconds'], hr['index'], hr['rate']))
+        return hr
+
+    # 进入批量导入模式：保存并删除 stardict 上所有的索引和触发器，关闭
+    # 同步写盘，不需要续传时日志放在内存里。删除的索引和触发器先记在
+    # stardict_resume 表里，进程中途退出时下次打开数据库会重建它们，
+    # 续传时上次没来得及重建的这次一起重建
+    def __bulk_begin(self, resumable=False):
+        c = self.__conn.cursor()
+        sql = "select name, sql from sqlite_master where type in "
+        sql += "('index', 'trigger') and tbl_name = 'stardict' "
+        sql += "and sql is not null;"
+        try:
+            self.__conn.commit()
+            c.execute(sql)
+            indexes = [tuple(n) for n in c.fetchall()]
+            text = self.resume_get(STARDICT_RESUME_INDEXES)
+            names = [n for n, _ in indexes]
+            for name, sql in json.loads(text or '[]'):
+                if name not in names:
+                    indexes.append((name, sql))
+            text = json.dumps(indexes)
+            self.resume_set(STARDICT_RESUME_INDEXES, text, True)
+            c.execute('PRAGMA journal_mode;')
+            journal = c.fetchone()[0]
+            c.execute('PRAGMA synchronous;')
+            synchronous = c.fetchone()[0]
+            if not resumable:
+                c.execute('PRAGMA journal_mode = MEMORY;')
+            c.execute('PRAGMA synchronous = OFF;')
+            for name, sql in indexes:
+                kind = schema_kind(sql).upper()
+                c.execute('DROP %s IF EXISTS "%s";' % (kind, name))
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return None
+        self.__bulk = True
+        return (indexes, journal, synchronous, resumable)
+
+    # 退出批量导入模式：重建索引和触发器，ANALYZE，恢复原来的设置，
+    # 重建派生数据，返回重建索引的耗时
+    def __bulk_end(self, state):
+        indexes, journal, synchronous, resumable = state
+        self.__bulk = False
+        ts = time.time()
+        self.__bulk_restore(indexes)
+        c = self.__conn.cursor()
+        c.execute('PRAGMA journal_mode = %s;' % journal)
+        c.execute('PRAGMA synchronous = %d;' % synchronous)
+        ts = time.time() - ts
+        self.__bulk_derive()
+        return ts
+
+    # 重建批量导入时删除的索引和触发器，已经存在的跳过。导入期间改动
+    # 计数的触发器不在，这里补记一次改动
+    def __bulk_restore(self, indexes):
+        c = self.__conn.cursor()
+        for name, sql in indexes:
+            if not self.__exists(name, schema_kind(sql)):
+                c.execute(sql)
+        if self.__exists('stardict_change'):
+            c.execute('UPDATE stardict_change SET serial = serial + 1;')
+        c.execute('ANALYZE;')
+        self.__conn.commit()
+        self.resume_clear(STARDICT_RESUME_INDEXES)
+        return True
+
+    # 整体重建批量导入时跳过的反查索引等派生数据
+    def __bulk_derive(self):
+        if self.__cjk:
+            self.cjk_rebuild()
+        if self.__prefix:
+            self.autocomplete_rebuild()
+        if self.__pattern:
+            self.pattern_rebuild()
         return True
 
+    # 上次批量导入中途退出时没有重建的索引和触发器，打开数据库时补上
+    def __bulk_recover(self):
+        text = self.resume_get(STARDICT_RESUME_INDEXES)
+        if not text:
+            return False
+        self.out('bulk: rebuild indexes left by an interrupted load')
+        self.__bulk_restore(json.loads(text))
+        self.__bulk_derive()
+        return True
+
+    # 读取断点续传的进度标记，没有时返回 None
+    def resume_get(self, name):
+        if not self.__exists('stardict_resume'):
+            return None
+        c = self.__conn.cursor()
+        c.execute('select value from stardict_resume where name = ?;', (name,))
+        record = c.fetchone()
+        return record and record[0] or None
+
+    # 保存进度标记，commit 为 False 时和调用者的写入一起提交
+    def resume_set(self, name, value, commit=True):
+        sql = 'CREATE TABLE IF NOT EXISTS "stardict_resume" ('
+        sql += '"name" VARCHAR(255) PRIMARY KEY NOT NULL, "value" TEXT);'
+        self.__conn.execute(sql)
+        sql = 'INSERT OR REPLACE INTO stardict_resume VALUES (?, ?);'
+        self.__conn.execute(sql, (name, value))
+        if commit:
+            self.__conn.commit()
+        return True
+
+    # 清除进度标记
+    def resume_clear(self, name):
+        if not self.__exists('stardict_resume'):
+            return False
+        sql = 'DELETE FROM stardict_resume WHERE name = ?;'
+        self.__conn.execute(sql, (name,))
+        self.__conn.commit()
+        return True
+
+    # 增量同步：records 为按单词（word_collate）排好序的 (word, items)
+    # 序列，和 stardict 表按相同顺序归并，只写入新增、改动和删除的行。
+    # 每行内容的哈希保存在 stardict_hash 表里，比较时不用解码旧数据；
+    # 行被别的途径修改或删除时由触发器清掉哈希，下次同步时补算。两边
+    # 排序对非 ASCII 大写字母可能不一致，没有配上的行暂存起来，最后
+    # 再决定是删除还是插入，所以内存占用只和改动的行数有关
+    def sync(self, records):
+        ts = time.time()
+        if not self.__hash_fill():
+            return None
+        hr = {'insert': 0, 'update': 0, 'delete': 0, 'same': 0}
+        select = 'id, word, (select hash from stardict_hash h '
+        select += 'where h.id = stardict.id)'
+        target = self.__keyset(select, BATCH_ROWS, None)
+        source = iter(records)
+        removed = {}
+        added = {}
+        drops = []
+        inserts = []
+        updates = []
+        # 配上的一对：单词大小写变了的当作删除加插入，否则比较哈希
+        def match(record, data):
+            if record[1] != data[0]:
+                drops.append(record[0])
+                inserts.append(data)
+            elif record[2] != record_hash(data[1]):
+                updates.append(data)
+                hr['update'] += 1
+            else:
+                hr['same'] += 1
+        try:
+            t = next(target, None)
+            s = next(source, None)
+            while t is not None or s is not None:
+                tkey = t is not None and word_collate(t[1]) or None
+                skey = s is not None and word_collate(s[0]) or None
+                if t is None or (s is not None and skey < tkey):
+                    record = removed.pop(skey, None)
+                    if record is None:
+                        added[skey] = s
+                    else:
+                        match(record, s)
+                    s = next(source, None)
+                elif s is None or tkey < skey:
+                    data = added.pop(tkey, None)
+                    if data is None:
+                        removed[tkey] = t
+                    else:
+                        match(t, data)
+                    t = next(target, None)
+                else:
+                    match(t, s)
+                    t = next(target, None)
+                    s = next(source, None)
+                if len(updates) >= BATCH_ROWS:
+                    self.__sync_write(updates, True)
+                    updates = []
+            self.__sync_write(updates, True)
+            drops.extend([record[0] for record in removed.values()])
+            for key in drops:
+                self.remove(key, False)
+            hr['delete'] += len(drops)
+            inserts.extend(added.values())
+            self.__sync_write(inserts, False)
+            hr['insert'] += len(inserts)
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            self.__conn.rollback()
+            return None
+        hr['seconds'] = time.time() - ts
+        self.out('sync: %d inserted, %d updated, %d deleted in %.2f seconds' % \
+                 (hr['insert'], hr['update'], hr['delete'], hr['seconds']))
+        return hr
+
+    # 写入同步的行并保存新的哈希，upsert 为 False 时是新增的行
+    def __sync_write(self, records, upsert):
+        if not records:
+            return True
+        if self.__write_many(records, upsert, False) is None:
+            raise sqlite3.OperationalError('sync write failed')
+        sql = 'INSERT OR REPLACE INTO stardict_hash(id, hash) '
+        sql += 'SELECT id, ? FROM stardict WHERE word = ?;'
+        args = [(record_hash(items), word) for word, items in records]
+        self.__conn.executemany(sql, args)
+        return True
+
+    # 建立 stardict_hash 表，补算没有哈希的行
+    def __hash_fill(self):
+        sql = '''
+		CREATE TABLE IF NOT EXISTS "stardict_hash" (
+			"id" INTEGER PRIMARY KEY NOT NULL,
+			"hash" INTEGER NOT NULL
+		);
+		CREATE TRIGGER IF NOT EXISTS "stardict_hash_au" AFTER UPDATE ON stardict
+		BEGIN
+			DELETE FROM stardict_hash WHERE id = old.id;
+		END;
+		CREATE TRIGGER IF NOT EXISTS "stardict_hash_ad" AFTER DELETE ON stardict
+		BEGIN
+			DELETE FROM stardict_hash WHERE id = old.id;
+		END;
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
+        select, layout = self.__projection(None)
+        reader = self.__conn.cursor()
+        try:
+            self.__conn.executescript(sql.strip('\n'))
+            reader.execute('select %s from stardict where id not in ' \
+                           '(select id from stardict_hash);' % select)
+            while True:
+                records = reader.fetchmany(BATCH_ROWS)
+                if not records:
+                    break
+                args = []
+                for record in records:
+                    data = self.__record2obj(record, layout)
+                    args.append((data['id'], record_hash(data)))
+                sql = 'INSERT INTO stardict_hash(id, hash) VALUES (?, ?);'
+                self.__conn.executemany(sql, args)
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            self.__conn.rollback()
+            return False
+        return True
+
+    # 派生数据：根据词条内容生成的反查索引等，写入单词以后在同一个
+    # 事务里同步更新，keys 为改动过的 id 或者单词，names 为改动的字段
+    def __derive(self, keys, names):
+        if self.__bulk:
+            return False
+        cjk = self.__cjk and ('translation' in names or 'word' in names)
+        prefix = False
+        if self.__prefix:
+            for name in ('word', 'frq', 'bnc', 'collins'):
+                if name in names:
+                    prefix = True
+        pattern = self.__pattern and ('word' in names)
+        if not (cjk or prefix or pattern):
+            return False
+        records = self.__derive_fetch(keys)
+        if cjk:
+            self.__cjk_index([(r['id'], r['translation']) for r in records])
+        if prefix:
+            self.__prefix_insert(records)
+        if pattern:
+            self.__pattern_index([(r['id'], r['word']) for r in records])
+        return True
+
+    # 取得计算派生数据需要的字段
+    def __derive_fetch(self, keys):
+        fields = ('translation', 'frq', 'bnc', 'collins')
+        def fetch(name, chunk):
+            select, layout = self.__projection(fields)
+            sql = 'select %s from stardict where %s in (%s);'
+            sql = sql % (select, name, ','.join(['?'] * len(chunk)))
+            c = self.__conn.cursor()
+            c.execute(sql, tuple(chunk))
+            return [self.__record2obj(row, layout) for row in c]
+        return [r for r in batch_lookup(keys, fetch) if r is not None]
+
     # 删除单词
     def remove(self, key, commit=True):
         if isinstance(key, int) or isinstance(key, long):
@@ -215,77 +1416,749 @@ class StarDict(object):
         else:
             sql = 'DELETE FROM stardict WHERE word=?;'
         try:
+            records = self.__prefix and self.__derive_fetch([key]) or []
             self.__conn.execute(sql, (key,))
+            if records:
+                self.__prefix_remove(records)
             if commit:
                 self.__conn.commit()
         except sqlite3.IntegrityError:
             return False
         return True
 
-    # 清空数据库
-    def delete_all(self, reset_id=False):
-        sql1 = 'DELETE FROM stardict;'
-        sql2 = "UPDATE sqlite_sequence SET seq = 0 WHERE name = 'stardict';"
+    # 清空数据库
+    def delete_all(self, reset_id=False):
+        sql1 = 'DELETE FROM stardict;'
+        sql2 = "UPDATE sqlite_sequence SET seq = 0 WHERE name = 'stardict';"
+        try:
+            self.__conn.execute(sql1)
+            if self.__prefix:
+                self.__conn.execute('DELETE FROM stardict_prefix;')
+            if reset_id:
+                self.__conn.execute(sql2)
+            self.__conn.commit()
+        except sqlite3.IntegrityError as e:
+            self.out(str(e))
+            return False
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return False
+        return True
+
+    # 更新单词数据
+    def update(self, key, items, commit=True):
+        return self.__update(key, items, commit)
+
+    # extra 为额外需要更新派生数据的字段，register 时为 ('word',)
+    def __update(self, key, items, commit, extra=()):
+        names = []
+        values = []
+        for name, id in self.__enable:
+            if name in items:
+                names.append(name)
+                value = items[name]
+                if name == 'detail':
+                    if value is not None:
+                        value = json.dumps(value, ensure_ascii=False)
+                values.append(value)
+        for name, value in derived_values(dict([(n, items[n]) for n in names])):
+            names.append(name)
+            values.append(value)
+        if len(names) == 0:
+            try:
+                if extra:
+                    self.__derive([key], extra)
+                if commit:
+                    self.__conn.commit()
+            except sqlite3.IntegrityError:
+                return False
+            return False
+        sql = 'UPDATE stardict SET ' + ', '.join(['%s=?' % n for n in names])
+        if isinstance(key, str) or isinstance(key, unicode):
+            sql += ' WHERE word=?;'
+        else:
+            sql += ' WHERE id=?;'
+        try:
+            self.__conn.execute(sql, tuple(values + [key]))
+            self.__derive([key], tuple(names) + tuple(extra))
+            if commit:
+                self.__conn.commit()
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    # 检测表格或者触发器是否存在
+    def __exists(self, name, kind='table'):
+        c = self.__conn.cursor()
+        sql = 'select 1 from sqlite_master where type = ? and name = ?;'
+        c.execute(sql, (kind, name))
+        return c.fetchone() is not None
+
+    # 英文释义全文索引是否已经建立
+    def fts_enabled(self):
+        return self.__exists('stardict_fts')
+
+    # 建立英文释义的 FTS5 全文索引（外部内容表），由触发器保持同步
+    def fts_enable(self):
+        sql = '''
+		CREATE VIRTUAL TABLE IF NOT EXISTS "stardict_fts" USING fts5(
+			definition, content='stardict', content_rowid='id'
+		);
+		CREATE TRIGGER IF NOT EXISTS "stardict_fts_ai" AFTER INSERT ON stardict
+		BEGIN
+			INSERT INTO stardict_fts(rowid, definition)
+				VALUES (new.id, new.definition);
+		END;
+		CREATE TRIGGER IF NOT EXISTS "stardict_fts_ad" AFTER DELETE ON stardict
+		BEGIN
+			INSERT INTO stardict_fts(stardict_fts, rowid, definition)
+				VALUES ('delete', old.id, old.definition);
+		END;
+		CREATE TRIGGER IF NOT EXISTS "stardict_fts_au"
+			AFTER UPDATE OF definition ON stardict
+		BEGIN
+			INSERT INTO stardict_fts(stardict_fts, rowid, definition)
+				VALUES ('delete', old.id, old.definition);
+			INSERT INTO stardict_fts(rowid, definition)
+				VALUES (new.id, new.definition);
+		END;
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
+        exists = self.fts_enabled()
+        try:
+            self.__conn.executescript(sql.strip('\n'))
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return False
+        if not exists:
+            return self.fts_rebuild()
+        return True
+
+    # 根据 stardict 表重建全文索引，用于已有的数据库
+    def fts_rebuild(self):
+        sql = "INSERT INTO stardict_fts(stardict_fts) VALUES ('rebuild');"
+        try:
+            self.__conn.execute(sql)
+            self.__conn.execute("INSERT INTO stardict_fts(stardict_fts) "
+                                "VALUES ('optimize');")
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return False
+        return True
+
+    # 删除全文索引和触发器
+    def fts_disable(self):
+        sql = '''
+		DROP TRIGGER IF EXISTS "stardict_fts_ai";
+		DROP TRIGGER IF EXISTS "stardict_fts_ad";
+		DROP TRIGGER IF EXISTS "stardict_fts_au";
+		DROP TABLE IF EXISTS "stardict_fts";
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
+        try:
+            self.__conn.executescript(sql.strip('\n'))
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return False
+        return True
+
+    # 建立中文释义的反查索引（汉字二元组倒排表），删除单词由触发器同步
+    def cjk_enable(self):
+        sql = '''
+		CREATE TABLE IF NOT EXISTS "stardict_cjk" (
+			"gram" VARCHAR(2) NOT NULL,
+			"id" INTEGER NOT NULL,
+			PRIMARY KEY ("gram", "id")
+		) WITHOUT ROWID;
+		CREATE INDEX IF NOT EXISTS "stardict_cjk_1" ON stardict_cjk (id);
+		CREATE TRIGGER IF NOT EXISTS "stardict_cjk_ad" AFTER DELETE ON stardict
+		BEGIN
+			DELETE FROM stardict_cjk WHERE id = old.id;
+		END;
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
+        try:
+            self.__conn.executescript(sql.strip('\n'))
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return False
+        self.__cjk = True
+        return self.cjk_rebuild()
+
+    # 根据 stardict 表重建反查索引
+    def cjk_rebuild(self):
+        if not self.__cjk:
+            return False
+        reader = self.__conn.cursor()
+        try:
+            self.__conn.execute('DELETE FROM stardict_cjk;')
+            sql = 'select id, translation from stardict '
+            sql += 'where translation is not null;'
+            reader.execute(sql)
+            while True:
+                rows = reader.fetchmany(BATCH_ROWS)
+                if not rows:
+                    break
+                self.__cjk_index(rows)
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            self.__conn.rollback()
+            return False
+        return True
+
+    # 删除反查索引
+    def cjk_disable(self):
+        sql = '''
+		DROP TRIGGER IF EXISTS "stardict_cjk_ad";
+		DROP TABLE IF EXISTS "stardict_cjk";
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
+        try:
+            self.__conn.executescript(sql.strip('\n'))
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return False
+        self.__cjk = False
+        return True
+
+    # 重新生成若干词条的汉字二元组，rows 为 [(id, translation), ...]
+    def __cjk_index(self, rows):
+        c = self.__conn.cursor()
+        c.executemany('DELETE FROM stardict_cjk WHERE id = ?;',
+                      [(row[0],) for row in rows])
+        grams = []
+        for id, text in rows:
+            for gram in cjk_grams(text):
+                grams.append((gram, id))
+        sql = 'INSERT OR IGNORE INTO stardict_cjk(gram, id) VALUES (?, ?);'
+        c.executemany(sql, grams)
+        return True
+
+    # 中文反查英文：求所有二元组倒排表的交集，再确认中文释义包含 text，
+    # 按柯林斯星级，牛津核心词汇和词频排序，没有建立反查索引返回 None
+    def reverse_lookup(self, text, limit=10, fields=None):
+        if not self.__cjk:
+            return None
+        grams = cjk_grams(text, True)[:32]
+        if not grams:
+            return []
+        select, layout = self.__projection(fields)
+        parts = []
+        params = []
+        for gram in grams:
+            if len(gram) == 1:
+                parts.append('SELECT id FROM stardict_cjk '
+                             'WHERE gram >= ? AND gram < ?')
+                params.extend([gram, unichr(ord(gram) + 1)])
+            else:
+                parts.append('SELECT id FROM stardict_cjk WHERE gram = ?')
+                params.append(gram)
+        like = text.replace('\\', '\\\\').replace('%', '\\%')
+        like = '%' + like.replace('_', '\\_') + '%'
+        sql = 'select %s from stardict where id in (%s) ' % \
+              (select, ' INTERSECT '.join(parts))
+        sql += "and translation like ? escape '\\' "
+        sql += 'order by collins desc, oxford desc, '
+        sql += '(frq is null or frq <= 0), frq limit ?;'
+        c = self.__conn.cursor()
+        c.execute(sql, tuple(params + [like, limit]))
+        return [self.__record2obj(record, layout) for record in c]
+
+    # 建立前缀补全表：每个前缀（单词小写后的前 AUTOCOMPLETE_DEPTH 个
+    # 字符以内）预先保存常用度最高的 AUTOCOMPLETE_SIZE 个单词
+    def autocomplete_enable(self):
+        sql = '''
+		CREATE TABLE IF NOT EXISTS "stardict_prefix" (
+			"prefix" VARCHAR(16) NOT NULL,
+			"score" INTEGER NOT NULL,
+			"id" INTEGER NOT NULL,
+			PRIMARY KEY ("prefix", "score", "id")
+		) WITHOUT ROWID;
+		CREATE INDEX IF NOT EXISTS "stardict_prefix_1" ON stardict_prefix (id);
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
+        try:
+            self.__conn.executescript(sql.strip('\n'))
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return False
+        self.__prefix = True
+        return self.autocomplete_rebuild()
+
+    # 重建前缀补全表：按单词顺序扫描一遍，相同前缀的单词是连续的，
+    # 每个前缀长度只需要维护一个大小为 AUTOCOMPLETE_SIZE 的候选列表
+    def autocomplete_rebuild(self):
+        if not self.__prefix:
+            return False
+        depth = AUTOCOMPLETE_DEPTH
+        size = AUTOCOMPLETE_SIZE
+        groups = [[None, []] for n in xrange(depth + 1)]
+        output = []
+        insert = 'INSERT OR IGNORE INTO stardict_prefix VALUES (?, ?, ?);'
+        reader = self.__conn.cursor()
+        writer = self.__conn.cursor()
+        def flush(group):
+            for score, id in group[1]:
+                output.append((group[0], score, id))
+            group[0] = None
+            group[1] = []
+        try:
+            writer.execute('DELETE FROM stardict_prefix;')
+            sql = 'select id, word, frq, bnc, collins from stardict '
+            sql += 'order by word collate nocase;'
+            reader.execute(sql)
+            while True:
+                rows = reader.fetchmany(BATCH_ROWS)
+                if not rows:
+                    break
+                for id, word, frq, bnc, collins in rows:
+                    key = word.lower()
+                    item = (word_score(frq, bnc, collins), id)
+                    for n in xrange(1, min(len(key), depth) + 1):
+                        group = groups[n]
+                        if group[0] != key[:n]:
+                            flush(group)
+                            group[0] = key[:n]
+                        if len(group[1]) < size or item < group[1][-1]:
+                            group[1].append(item)
+                            group[1].sort()
+                            del group[1][size:]
+                if len(output) >= BATCH_ROWS:
+                    writer.executemany(insert, output)
+                    output = []
+            for group in groups:
+                flush(group)
+            writer.executemany(insert, output)
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            self.__conn.rollback()
+            return False
+        return True
+
+    # 删除前缀补全表
+    def autocomplete_disable(self):
+        try:
+            self.__conn.execute('DROP TABLE IF EXISTS "stardict_prefix";')
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return False
+        self.__prefix = False
+        return True
+
+    # 单词所有需要保存的前缀
+    def __prefix_keys(self, word):
+        key = word.lower()
+        return [key[:n] for n in xrange(1, min(len(key), AUTOCOMPLETE_DEPTH) + 1)]
+
+    # 新增或者常用度改变的单词，依次检查它的每个前缀
+    def __prefix_insert(self, records):
+        c = self.__conn.cursor()
+        size = AUTOCOMPLETE_SIZE
+        for record in records:
+            id = record['id']
+            item = (word_score(record['frq'], record['bnc'],
+                               record['collins']), id)
+            for prefix in self.__prefix_keys(record['word']):
+                sql = 'select score, id from stardict_prefix where prefix = ? '
+                sql += 'order by score, id;'
+                c.execute(sql, (prefix,))
+                items = [tuple(n) for n in c.fetchall()]
+                if item in items:
+                    continue
+                if id in [n[1] for n in items]:
+                    # 常用度变了，原来在表里，可能有别的单词要补进来
+                    self.__prefix_refill(prefix)
+                    continue
+                if len(items) >= size and item > items[size - 1]:
+                    continue
+                sql = 'INSERT INTO stardict_prefix VALUES (?, ?, ?);'
+                c.execute(sql, (prefix, item[0], id))
+                sql = 'DELETE FROM stardict_prefix '
+                sql += 'WHERE prefix = ? AND score = ? AND id = ?;'
+                for score, n in sorted(items + [item])[size:]:
+                    c.execute(sql, (prefix, score, n))
+        return True
+
+    # 单词删除以后，如果它在某个前缀的候选里，重新计算该前缀
+    def __prefix_remove(self, records):
+        c = self.__conn.cursor()
+        for record in records:
+            for prefix in self.__prefix_keys(record['word']):
+                sql = 'DELETE FROM stardict_prefix WHERE prefix = ? AND id = ?;'
+                c.execute(sql, (prefix, record['id']))
+                if c.rowcount > 0:
+                    self.__prefix_refill(prefix)
+        return True
+
+    # 用前缀范围扫描重新计算某个前缀的候选列表
+    def __prefix_refill(self, prefix):
+        c = self.__conn.cursor()
+        sql = 'select %s, id from stardict where word >= ? and word < ? '
+        sql += 'order by 1, id limit ?;'
+        sql = sql % WORD_SCORE_SQL
+        upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        c.execute(sql, (prefix, upper, AUTOCOMPLETE_SIZE))
+        items = c.fetchall()
+        c.execute('DELETE FROM stardict_prefix WHERE prefix = ?;', (prefix,))
+        sql = 'INSERT INTO stardict_prefix VALUES (?, ?, ?);'
+        c.executemany(sql, [(prefix, score, id) for score, id in items])
+        return True
+
+    # 前缀补全：返回以 prefix 开头的最常用的 limit 个单词 [(id, word)]，
+    # 有前缀补全表并且在表的范围内时直接查表，否则用前缀范围扫描
+    def autocomplete(self, prefix, limit=10):
+        key = prefix.lower()
+        if not key:
+            return []
+        c = self.__conn.cursor()
+        if self.__prefix and len(key) <= AUTOCOMPLETE_DEPTH:
+            if limit <= AUTOCOMPLETE_SIZE:
+                sql = 'select p.id, s.word from stardict_prefix as p '
+                sql += 'join stardict as s on s.id = p.id '
+                sql += 'where p.prefix = ? order by p.score, p.id limit ?;'
+                c.execute(sql, (key, limit))
+                return [tuple(record) for record in c]
+        sql = 'select id, word from stardict where word >= ? and word < ? '
+        sql += 'order by %s, id limit ?;' % WORD_SCORE_SQL
+        upper = key[:-1] + unichr(ord(key[-1]) + 1)
+        c.execute(sql, (key, upper, limit))
+        return [tuple(record) for record in c]
+
+    # 建立通配符索引：(位置, 字母, 长度) 到单词的倒排表，位置从 0 开始，
+    # 负数表示从结尾数起，删除单词由触发器同步
+    def pattern_enable(self):
+        sql = '''
+		CREATE TABLE IF NOT EXISTS "stardict_pattern" (
+			"pos" INTEGER NOT NULL,
+			"letter" VARCHAR(1) NOT NULL,
+			"size" INTEGER NOT NULL,
+			"id" INTEGER NOT NULL,
+			PRIMARY KEY ("pos", "letter", "size", "id")
+		) WITHOUT ROWID;
+		CREATE INDEX IF NOT EXISTS "stardict_pattern_1" ON stardict_pattern (id);
+		CREATE TRIGGER IF NOT EXISTS "stardict_pattern_ad" AFTER DELETE ON stardict
+		BEGIN
+			DELETE FROM stardict_pattern WHERE id = old.id;
+		END;
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
         try:
-            self.__conn.execute(sql1)
-            if reset_id:
-                self.__conn.execute(sql2)
+            self.__conn.executescript(sql.strip('\n'))
             self.__conn.commit()
-        except sqlite3.IntegrityError as e:
+        except sqlite3.Error as e:
             self.out(str(e))
             return False
+        self.__pattern = True
+        return self.pattern_rebuild()
+
+    # 根据 stardict 表重建通配符索引
+    def pattern_rebuild(self):
+        if not self.__pattern:
+            return False
+        reader = self.__conn.cursor()
+        try:
+            self.__conn.execute('DELETE FROM stardict_pattern;')
+            reader.execute('select id, word from stardict;')
+            while True:
+                rows = reader.fetchmany(BATCH_ROWS)
+                if not rows:
+                    break
+                self.__pattern_index(rows, False)
+            self.__conn.commit()
         except sqlite3.Error as e:
             self.out(str(e))
+            self.__conn.rollback()
             return False
         return True
 
-    # 更新单词数据
-    def update(self, key, items, commit=True):
-        names = []
-        values = []
-        for name, id in self.__enable:
-            if name in items:
-                names.append(name)
-                value = items[name]
-                if name == 'detail':
-                    if value is not None:
-                        value = json.dumps(value, ensure_ascii=False)
-                values.append(value)
-        if len(names) == 0:
-            if commit:
-                try:
-                    self.__conn.commit()
-                except sqlite3.IntegrityError:
-                    return False
-            return False
-        sql = 'UPDATE stardict SET ' + ', '.join(['%s=?' % n for n in names])
-        if isinstance(key, str) or isinstance(key, unicode):
-            sql += ' WHERE word=?;'
-        else:
-            sql += ' WHERE id=?;'
+    # 删除通配符索引
+    def pattern_disable(self):
+        sql = '''
+		DROP TRIGGER IF EXISTS "stardict_pattern_ad";
+		DROP TABLE IF EXISTS "stardict_pattern";
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
         try:
-            self.__conn.execute(sql, tuple(values + [key]))
-            if commit:
-                self.__conn.commit()
-        except sqlite3.IntegrityError:
+            self.__conn.executescript(sql.strip('\n'))
+            self.__conn.commit()
+        except sqlite3.Error as e:
+            self.out(str(e))
             return False
+        self.__pattern = False
+        return True
+
+    # 单词小写以后每个字母的 (位置, 字母, 长度)
+    def __pattern_keys(self, word):
+        key = word.lower()
+        size = len(key)
+        keys = [(i, key[i], size) for i in xrange(size)]
+        for i in xrange(max(0, size - PATTERN_TAIL), size):
+            keys.append((i - size, key[i], size))
+        return keys
+
+    # 重新生成若干词条的通配符索引，rows 为 [(id, word), ...]
+    def __pattern_index(self, rows, clean=True):
+        c = self.__conn.cursor()
+        if clean:
+            c.executemany('DELETE FROM stardict_pattern WHERE id = ?;',
+                          [(row[0],) for row in rows])
+        keys = []
+        for id, word in rows:
+            for pos, letter, size in self.__pattern_keys(word):
+                keys.append((pos, letter, size, id))
+        sql = 'INSERT OR IGNORE INTO stardict_pattern VALUES (?, ?, ?, ?);'
+        c.executemany(sql, keys)
         return True
 
-    # 浏览词典
+    # 通配符查询：? 匹配一个字符，* 匹配任意个字符，大小写不敏感，
+    # 返回 [(id, word)]。开头和结尾固定的字母通过索引求交集，再用
+    # GLOB 确认；没有建立索引或者没有固定字母时退化成扫描
+    def pattern_search(self, pattern, limit=10, order_by='frq'):
+        key = pattern.lower()
+        if not key:
+            return []
+        order = word_order(order_by)
+        parts = key.split('*')
+        size = len(key) - key.count('*')
+        letters = [(i, ch) for i, ch in enumerate(parts[0]) if ch != '?']
+        if len(parts) > 1:
+            tail = parts[-1]
+            for i, ch in enumerate(tail):
+                pos = i - len(tail)
+                if ch != '?' and pos >= -PATTERN_TAIL:
+                    letters.append((pos, ch))
+        glob = key.replace('[', '[[]')
+        c = self.__conn.cursor()
+        if self.__pattern and letters:
+            query = 'SELECT id FROM stardict_pattern '
+            query += 'WHERE pos = ? AND letter = ? AND size %s ?'
+            query = query % ((len(parts) > 1) and '>=' or '=')
+            params = []
+            for pos, ch in letters:
+                params.extend([pos, ch, size])
+            sql = 'select id, word from stardict where id in (%s) ' % \
+                  ' INTERSECT '.join([query] * len(letters))
+            sql += 'and lower(word) glob ? order by %s, id limit ?;' % order
+            c.execute(sql, tuple(params + [glob, limit]))
+            return [tuple(record) for record in c]
+        sql = 'select id, word from stardict where lower(word) glob ? '
+        sql += 'order by %s, id limit ?;' % order
+        c.execute(sql, (glob, limit))
+        return [tuple(record) for record in c]
+
+    # 变位词：和 word 字母完全相同的其它单词，返回 [(id, word)]
+    def anagrams(self, word, limit=10, order_by='frq'):
+        sw = stripword(word)
+        if not sw:
+            return []
+        sql = 'select id, word from stardict where sig = ? and sw != ? '
+        sql += 'order by %s, id limit ?;' % word_order(order_by)
+        c = self.__conn.cursor()
+        c.execute(sql, (word_signature(sw), sw, limit))
+        return [tuple(record) for record in c]
+
+    # 子变位词：用 letters 里的字母（每个最多用一次）能拼出的单词，
+    # 至少 min_len 个字母。枚举 letters 的所有子集的签名去查索引，
+    # 返回 [(id, word)]，字母多的在前，相同的按常用度排序
+    def sub_anagrams(self, letters, min_len=3, limit=100):
+        sig = word_signature(stripword(letters))
+        counts = []
+        for ch in sig:
+            if counts and counts[-1][0] == ch:
+                counts[-1][1] += 1
+            else:
+                counts.append([ch, 1])
+        total = 1
+        for ch, n in counts:
+            total *= n + 1
+        min_len = max(min_len, 1)
+        found = []
+        c = self.__conn.cursor()
+        if total <= SUBANAGRAM_SIGNATURES:
+            sigs = ['']
+            for ch, n in counts:
+                sigs = [s + ch * k for s in sigs for k in xrange(n + 1)]
+            sigs = [s for s in sigs if len(s) >= min_len]
+            for pos in xrange(0, len(sigs), BATCH_CHUNK):
+                chunk = sigs[pos:pos + BATCH_CHUNK]
+                sql = 'select id, word, sig, frq, bnc, collins from stardict '
+                sql += 'where sig in (%s);' % ','.join(['?'] * len(chunk))
+                c.execute(sql, tuple(chunk))
+                found.extend(c.fetchall())
+        else:
+            have = dict([(ch, n) for ch, n in counts])
+            sql = 'select id, word, sig, frq, bnc, collins from stardict '
+            sql += 'where length(sig) between ? and ?;'
+            c.execute(sql, (min_len, len(sig)))
+            for record in c:
+                need = {}
+                for ch in record[2]:
+                    need[ch] = need.get(ch, 0) + 1
+                if not [ch for ch in need if need[ch] > have.get(ch, 0)]:
+                    found.append(record)
+        found.sort(key=lambda r: (-len(r[2]), word_score(r[3], r[4], r[5]), r[0]))
+        return [(r[0], r[1]) for r in found[:limit]]
+
+    # 读音相近的单词：和 word 的 Metaphone 读音键相同，返回 [(id, word)]
+    def sounds_like(self, word, limit=10, order_by='frq'):
+        key = metaphone(word)
+        if not key:
+            return []
+        sql = 'select id, word from stardict where sound = ? '
+        sql += 'order by %s, id limit ?;' % word_order(order_by)
+        c = self.__conn.cursor()
+        c.execute(sql, (key, limit))
+        return [tuple(record) for record in c]
+
+    # 以 suffix 结尾的单词（忽略大小写和标点），在反转 sw 的索引上做
+    # 范围扫描，order_by 为 None 时按索引顺序返回，返回 [(id, word)]
+    def ends_with(self, suffix, limit=10, order_by='frq'):
+        key = word_reverse(stripword(suffix))
+        if not key:
+            return []
+        upper = key[:-1] + unichr(ord(key[-1]) + 1)
+        sql = 'select id, word from stardict where rsw >= ? and rsw < ? '
+        if order_by is None:
+            sql += 'order by rsw, word collate nocase limit ?;'
+        else:
+            sql += 'order by %s, id limit ?;' % word_order(order_by)
+        c = self.__conn.cursor()
+        c.execute(sql, (key, upper, limit))
+        return [tuple(record) for record in c]
+
+    # 押韵的单词：韵脚和 word 的音标韵脚相同，word 不在词典里或者
+    # 没有音标时返回空列表
+    def rhymes(self, word, limit=10, order_by='frq'):
+        c = self.__conn.cursor()
+        c.execute('select phonetic from stardict where word = ?;', (word,))
+        record = c.fetchone()
+        key = record and rhyme_key(record[0]) or None
+        if not key:
+            return []
+        sql = 'select id, word from stardict where rhyme = ? and word != ? '
+        sql += 'order by %s, id limit ?;' % word_order(order_by)
+        c.execute(sql, (key, word, limit))
+        return [tuple(record) for record in c]
+
+    # 按考试标签和常用度筛选单词，逐条返回 fields 指定字段的记录：
+    # 包含 include_tags 里的所有标签，不包含 exclude_tags 里的任何标签，
+    # frq/bnc 排名不超过给定值，柯林斯星级不低于 collins_min，oxford
+    # 为 True/False 时只要（不要）牛津核心词汇。满足标签条件的位图
+    # 最多 256 种，直接展开成 IN 列表走 tagmask 索引
+    def select_words(self, include_tags=(), exclude_tags=(), frq_max=None,
+                     bnc_max=None, collins_min=None, oxford=None,
+                     fields=(), order_by=None):
+        if isinstance(include_tags, (str, unicode)):
+            include_tags = include_tags.split()
+        if isinstance(exclude_tags, (str, unicode)):
+            exclude_tags = exclude_tags.split()
+        for name in tuple(include_tags) + tuple(exclude_tags):
+            if name not in TAG_NAMES:
+                raise KeyError('unknown tag: %s' % name)
+        include = tag_mask(' '.join(include_tags))
+        exclude = tag_mask(' '.join(exclude_tags))
+        conds = []
+        params = []
+        if include or exclude:
+            masks = [n for n in xrange(1 << len(TAG_NAMES))
+                     if (n & include) == include and (n & exclude) == 0]
+            conds.append('tagmask in (%s)' % ','.join([str(n) for n in masks]))
+        for name, value in (('frq', frq_max), ('bnc', bnc_max)):
+            if value is not None:
+                conds.append('%s > 0 and %s <= ?' % (name, name))
+                params.append(value)
+        if collins_min is not None:
+            conds.append('collins >= ?')
+            params.append(collins_min)
+        if oxford is not None:
+            conds.append(oxford and 'oxford > 0' or 'ifnull(oxford, 0) = 0')
+        select, layout = self.__projection(fields)
+        sql = 'select %s from stardict' % select
+        if conds:
+            sql += ' where ' + ' and '.join(conds)
+        if order_by is not None:
+            sql += ' order by %s, id' % word_order(order_by)
+        c = self.__conn.cursor()
+        c.execute(sql + ';', tuple(params))
+        while True:
+            records = c.fetchmany(BATCH_ROWS)
+            if not records:
+                break
+            for record in records:
+                yield self.__record2obj(record, layout)
+
+    # 英文释义全文搜索，按 BM25 排序，返回 [(id, word, snippet, score)]
+    # query 使用 FTS5 的查询语法，没有建立索引或者语法错误返回 None
+    def search_definition(self, query, limit=10, mark=('[', ']'), size=12):
+        sql = '''
+		SELECT s.id, s.word, snippet(stardict_fts, 0, ?, ?, '...', ?),
+			bm25(stardict_fts) AS score
+		FROM stardict_fts JOIN stardict AS s ON s.id = stardict_fts.rowid
+		WHERE stardict_fts MATCH ? ORDER BY score LIMIT ?;
+		'''
+        c = self.__conn.cursor()
+        try:
+            c.execute(sql, (mark[0], mark[1], size, query, limit))
+            records = c.fetchall()
+        except sqlite3.Error as e:
+            self.out(str(e))
+            return None
+        return [tuple(record) for record in records]
+
+    # 浏览词典：返回 (id, word)，分批读取不会长时间占用游标
     def __iter__(self):
+        for record in self.__keyset('id, word', BATCH_ROWS, None):
+            yield tuple(record)
+
+    # 按单词顺序逐条返回 fields 指定字段的记录，从 start_after 之后开始
+    def iter_rows(self, batch_size=BATCH_ROWS, fields=None, start_after=None):
+        select, layout = self.__projection(fields)
+        for record in self.__keyset(select, batch_size, start_after):
+            yield self.__record2obj(record, layout)
+
+    # 键集分页：每批用 word > 上一批最后的单词继续，内存占用不变，
+    # 中断以后可以从任意单词继续，select 的第二列必须是 word
+    def __keyset(self, select, batch_size, start_after):
+        sql = 'select %s from stardict ' % select
+        order = 'order by word collate nocase limit ?;'
         c = self.__conn.cursor()
-        sql = 'select "id", "word" from "stardict"'
-        sql += ' order by "word" collate nocase;'
-        c.execute(sql)
-        return c.__iter__()
+        last = start_after
+        while True:
+            if last is None:
+                c.execute(sql + order, (batch_size,))
+            else:
+                c.execute(sql + 'where word > ? ' + order, (last, batch_size))
+            records = c.fetchmany(batch_size)
+            for record in records:
+                yield record
+            if len(records) < batch_size:
+                break
+            last = records[-1][1]
 
     # 取得长度
     def __len__(self):
         return self.count()
 
-    # 检测存在
+    # 检测存在：只查询主键和单词索引，不取出词条内容
     def __contains__(self, key):
-        return self.query(key) != None
+        if isinstance(key, int) or isinstance(key, long):
+            sql = 'select 1 from stardict where id = ?;'
+        elif isinstance(key, str) or isinstance(key, unicode):
+            sql = 'select 1 from stardict where word = ?;'
+        else:
+            return False
+        c = self.__conn.cursor()
+        c.execute(sql, (key,))
+        return c.fetchone() is not None
 
     # 查询单词
     def __getitem__(self, key):
@@ -304,6 +2177,121 @@ class StarDict(object):
     def dumps(self):
         return [n for _, n in self.__iter__()]
 
+    # 拼写建议（did you mean）：返回 [(word, distance), ...]
+    def suggest(self, word, max_distance=SPELL_DISTANCE, limit=10):
+        speller = self.__speller()
+        if speller is None:
+            return None
+        return speller.suggest(word, max_distance, limit)
+
+    # 重建拼写建议索引
+    def spell_rebuild(self):
+        return self.__speller(True) is not None
+
+    # 打开拼写索引，词典指纹和建立时不一致就重建
+    def __speller(self, rebuild=False):
+        if self.__spell is None:
+            self.__spell = SpellIndex(self.__dbname + '.spell')
+        source = self.__spell_source()
+        if rebuild or self.__spell.source() != source:
+            self.__spell.build(self.__spell_rows(), source)
+        return self.__spell
+
+    # 拼写索引的来源指纹：触发器维护的改动计数加上最大 id，任何途径的
+    # 增删和 word/frq/bnc/collins 的修改都会改变它。计数表和触发器在
+    # __open 建表时创建，只读打开的老版本数据库没有计数表时退回到词条
+    # 数量和最大 id
+    def __spell_source(self):
+        c = self.__conn.cursor()
+        c.execute('select max(id) from stardict;')
+        maxid = c.fetchone()[0]
+        if not self.__exists('stardict_change'):
+            return '%d:%s' % (self.count(), maxid)
+        c.execute('select serial from stardict_change;')
+        record = c.fetchone()
+        return '%d:%s' % (record and record[0] or 0, maxid)
+
+    def __spell_rows(self):
+        c = self.__conn.cursor()
+        c.execute('select word, sw, frq, bnc, collins from stardict;')
+        for word, sw, frq, bnc, collins in c:
+            yield word, sw, word_score(frq, bnc, collins)
+
+
+# ----------------------------------------------------------------------
+# StarDictPool: 每个线程独立的 StarDict 连接，接口和 StarDict 相同
+# ----------------------------------------------------------------------
+class StarDictPool(object):
+    def __init__(self, filename, **argv):
+        self.__dbname = os.path.abspath(filename)
+        self.__argv = argv
+        self.__argv['check_same_thread'] = False
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__alive = weakref.WeakValueDictionary()
+        self.__serial = 0
+        # 先在当前线程打开一次，数据库不存在或者建表失败时尽早报错
+        self.__current()
+
+    # 取得当前线程的连接，没有就创建，线程退出时随线程局部变量释放
+    def __current(self):
+        sd = getattr(self.__local, 'sd', None)
+        if sd is None:
+            sd = StarDict(self.__dbname, **self.__argv)
+            self.__local.sd = sd
+            with self.__lock:
+                self.__serial += 1
+                self.__alive[self.__serial] = sd
+        return sd
+
+    # 当前打开的连接数量
+    def size(self):
+        with self.__lock:
+            return len(self.__alive)
+
+    # 关闭所有线程的连接
+    def close(self):
+        with self.__lock:
+            alive = list(self.__alive.values())
+            self.__alive.clear()
+        for sd in alive:
+            sd.close()
+        self.__local = type(self.__local)()
+        return True
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    # 其他接口都转发给当前线程的 StarDict
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.__current(), name)
+
+    def query(self, key, fields=None):
+        return self.__current().query(key, fields)
+
+    def match(self, word, limit=10, strip=False):
+        return self.__current().match(word, limit, strip)
+
+    def query_batch(self, keys, fields=None):
+        return self.__current().query_batch(keys, fields)
+
+    def __iter__(self):
+        return self.__current().__iter__()
+
+    def __len__(self):
+        return self.__current().__len__()
+
+    def __contains__(self, key):
+        return self.__current().__contains__(key)
+
+    def __getitem__(self, key):
+        return self.__current().__getitem__(key)
+
 
 # ----------------------------------------------------------------------
 # startup MySQLdb
@@ -337,6 +2325,7 @@ class DictMySQL(object):
                 self.__uri[k] = v
         self.__uri['connect_timeout'] = timeout
         self.__conn = None
+        self.__spell = None
         self.__verbose = verbose
         self.__init = init
         if not 'db' in argv:
@@ -355,6 +2344,7 @@ class DictMySQL(object):
         for k, v in self.__fields:
             self.__names[k] = v
         self.__enable = self.__fields[3:]
+        self.__projects = {}
         self.__db = self.__argv.get('db', 'stardict')
         if not self.__init:
             uri = {}
@@ -442,44 +2432,51 @@ class DictMySQL(object):
             obj['db'] = part[1]
         return obj
 
-    # 数据库记录转化为字典
-    def __record2obj(self, record):
+    # 字段投影，结果缓存起来，返回 (select 列名, 记录布局)
+    def __projection(self, fields):
+        key = None
+        if fields is not None:
+            key = tuple(fields)
+        proj = self.__projects.get(key, None)
+        if proj is None:
+            proj = field_projection(fields)
+            self.__projects[key] = proj
+        return proj
+
+    # 数据库记录转化为 DictRecord
+    def __record2obj(self, record, layout=None):
         if record is None:
             return None
-        word = {}
-        for k, v in self.__fields:
-            word[k] = record[v]
-        if word['detail']:
-            text = word['detail']
-            try:
-                obj = json.loads(text)
-            except:
-                obj = None
-            word['detail'] = obj
-        return word
+        if layout is None:
+            layout = self.__projection(None)[1]
+        return DictRecord(layout, record)
 
     # 关闭数据库
     def close(self):
         if self.__conn:
             self.__conn.close()
         self.__conn = None
+        if self.__spell:
+            self.__spell.close()
+        self.__spell = None
 
     def __del__(self):
         self.close()
 
     # 查询单词
-    def query(self, key):
+    def query(self, key, fields=None):
+        select, layout = self.__projection(fields)
         record = None
         if isinstance(key, int) or isinstance(key, long):
-            sql = 'select * from stardict where id = %s;'
+            sql = 'select %s from stardict where id = %%s;' % select
         elif isinstance(key, str) or isinstance(key, unicode):
-            sql = 'select * from stardict where word = %s;'
+            sql = 'select %s from stardict where word = %%s;' % select
         else:
             return None
         with self.__conn as c:
             c.execute(sql, (key,))
             record = c.fetchone()
-        return self.__record2obj(record)
+        return self.__record2obj(record, layout)
 
     # 查询单词匹配
     def match(self, word, limit=10, strip=False):
@@ -498,37 +2495,31 @@ class DictMySQL(object):
             result.append(tuple(record))
         return result
 
-    # 批量查询
-    def query_batch(self, keys):
-        sql = 'select * from stardict where '
-        if keys is None:
-            return None
-        if not keys:
-            return []
-        querys = []
-        for key in keys:
-            if isinstance(key, int) or isinstance(key, long):
-                querys.append('id = %s')
-            elif key is not None:
-                querys.append('word = %s')
-        sql = sql + ' or '.join(querys) + ';'
-        query_word = {}
-        query_id = {}
+    # 查询单词匹配，直接返回匹配到的记录
+    def match_rows(self, word, limit=10, strip=False, fields=None):
+        select, layout = self.__projection(fields)
+        if not strip:
+            sql = 'select %s from stardict where word >= %%s ' % select
+            sql += 'order by word limit %s;'
+        else:
+            sql = 'select %s from stardict where sw >= %%s ' % select
+            sql += 'order by sw, word limit %s;'
+            word = stripword(word)
         with self.__conn as c:
-            c.execute(sql, tuple(keys))
-            for row in c:
-                obj = self.__record2obj(row)
-                query_word[obj['word'].lower()] = obj
-                query_id[obj['id']] = obj
-        results = []
-        for key in keys:
-            if isinstance(key, int) or isinstance(key, long):
-                results.append(query_id.get(key, None))
-            elif key is not None:
-                results.append(query_word.get(key.lower(), None))
-            else:
-                results.append(None)
-        return tuple(results)
+            c.execute(sql, (word, limit))
+            records = c.fetchall()
+        return [self.__record2obj(record, layout) for record in records]
+
+    # 批量查询
+    def query_batch(self, keys, fields=None):
+        select, layout = self.__projection(fields)
+        def fetch(name, chunk):
+            sql = 'select %s from stardict where %s in (%s);'
+            sql = sql % (select, name, ','.join(['%s'] * len(chunk)))
+            with self.__conn as c:
+                c.execute(sql, tuple(chunk))
+                return [self.__record2obj(row, layout) for row in c]
+        return batch_lookup(keys, fetch)
 
     # 注册新单词
     def register(self, word, items, commit=True):
@@ -542,6 +2533,45 @@ class DictMySQL(object):
         self.update(word, items, commit)
         return True
 
+    # 批量注册新单词，已经存在的跳过
+    def register_many(self, records, commit=True):
+        return self.__write_many(records, False, commit)
+
+    # 批量写入：不存在的注册，存在的更新 items 里给出的字段
+    def upsert_many(self, records, commit=True):
+        return self.__write_many(records, True, commit)
+
+    # 每条语句插入多行，行数不宜太多，避免超过 max_allowed_packet
+    def __write_many(self, records, upsert, commit):
+        ts = time.time()
+        names = [n for n, _ in self.__enable]
+        count = 0
+        changes = 0
+        try:
+            for keys, rows in batch_records(records, names, 200):
+                cols = ('word', 'sw') + keys
+                mark = '(' + ', '.join(['%s'] * len(cols)) + ')'
+                sql = 'INSERT INTO stardict(%s) VALUES ' % ', '.join(cols)
+                sql += ', '.join([mark] * len(rows))
+                if upsert and keys:
+                    sets = ['%s=VALUES(%s)' % (n, n) for n in keys]
+                    sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join(sets)
+                else:
+                    sql += ' ON DUPLICATE KEY UPDATE id=id'
+                params = []
+                for row in rows:
+                    params.extend(row)
+                with self.__conn as c:
+                    c.execute(sql + ';', tuple(params))
+                    changes += c.rowcount
+                count += len(rows)
+            if commit:
+                self.__conn.commit()
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            return None
+        return batch_report(count, changes, ts)
+
     # 删除单词
     def remove(self, key, commit=True):
         if isinstance(key, int) or isinstance(key, long):
@@ -560,7 +2590,8 @@ class DictMySQL(object):
     def delete_all(self, reset_id=False):
         sql1 = 'DELETE FROM stardict;'
         try:
-            self.__cursor.execute(sql1)
+            with self.__conn as c:
+                c.execute(sql1)
             self.__conn.commit()
         except MySQLdb.Error as e:
             self.out(str(e))
@@ -617,18 +2648,167 @@ class DictMySQL(object):
     def __len__(self):
         return self.count()
 
-    # 检测存在
+    # 检测存在：只查询主键和单词索引，不取出词条内容
     def __contains__(self, key):
-        return self.query(key) != None
+        if isinstance(key, int) or isinstance(key, long):
+            sql = 'select 1 from stardict where id = %s;'
+        elif isinstance(key, str) or isinstance(key, unicode):
+            sql = 'select 1 from stardict where word = %s;'
+        else:
+            return False
+        with self.__conn as c:
+            c.execute(sql, (key,))
+            record = c.fetchone()
+        return record is not None
 
     # 查询单词
     def __getitem__(self, key):
         return self.query(key)
 
+    # 浏览词典：返回 (id, word)
+    def __iter__(self):
+        for record in self.__keyset('id, word', BATCH_ROWS, None):
+            yield tuple(record)
+
+    # 按单词顺序逐条返回 fields 指定字段的记录，从 start_after 之后开始
+    def iter_rows(self, batch_size=BATCH_ROWS, fields=None, start_after=None):
+        select, layout = self.__projection(fields)
+        for record in self.__keyset(select, batch_size, start_after):
+            yield self.__record2obj(record, layout)
+
+    # 提交变更
+    def commit(self):
+        try:
+            self.__conn.commit()
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            self.__conn.rollback()
+            return False
+        return True
+
+    # 读取断点续传的进度标记，没有时返回 None
+    def resume_get(self, name):
+        sql = 'SELECT value FROM stardict_resume WHERE name=%s;'
+        try:
+            with self.__conn as c:
+                c.execute(sql, (name,))
+                record = c.fetchone()
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            return None
+        return record and record[0] or None
+
+    # 保存进度标记，表是 MyISAM 的，标记总在数据写完以后再保存
+    def resume_set(self, name, value, commit=True):
+        sql1 = 'CREATE TABLE IF NOT EXISTS stardict_resume ('
+        sql1 += '`name` VARCHAR(255) PRIMARY KEY NOT NULL, `value` TEXT)'
+        sql1 += ' ENGINE=MyISAM DEFAULT CHARSET=utf8;'
+        sql2 = 'REPLACE INTO stardict_resume VALUES (%s, %s);'
+        try:
+            with self.__conn as c:
+                c.execute(sql1)
+                c.execute(sql2, (name, value))
+            if commit:
+                self.__conn.commit()
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            return False
+        return True
+
+    # 清除进度标记
+    def resume_clear(self, name):
+        sql = 'DELETE FROM stardict_resume WHERE name=%s;'
+        try:
+            with self.__conn as c:
+                c.execute(sql, (name,))
+            self.__conn.commit()
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            return False
+        return True
+
+    # 键集分页，和 StarDict 相同，select 的第二列必须是 word
+    def __keyset(self, select, batch_size, start_after):
+        sql = 'select %s from stardict ' % select
+        order = 'order by word limit %s;'
+        last = start_after
+        while True:
+            with self.__conn as c:
+                if last is None:
+                    c.execute(sql + order, (batch_size,))
+                else:
+                    c.execute(sql + 'where word > %s ' + order,
+                              (last, batch_size))
+                records = c.fetchall()
+            for record in records:
+                yield record
+            if len(records) < batch_size:
+                break
+            last = records[-1][1]
+
     # 取得所有单词
     def dumps(self):
         return [n for _, n in self.__iter__()]
 
+    # 拼写建议（did you mean）：返回 [(word, distance), ...]
+    def suggest(self, word, max_distance=SPELL_DISTANCE, limit=10):
+        speller = self.__speller()
+        if speller is None:
+            return None
+        return speller.suggest(word, max_distance, limit)
+
+    # 重建拼写建议索引
+    def spell_rebuild(self):
+        return self.__speller(True) is not None
+
+    # 打开拼写索引，词典指纹和建立时不一致就重建
+    def __speller(self, rebuild=False):
+        if self.__spell is None:
+            self.__spell = SpellIndex(self.__spell_name())
+        source = self.__spell_source()
+        if source is None:
+            return None
+        if rebuild or self.__spell.source() != source:
+            self.__spell.build(self.__spell_rows(), source)
+        return self.__spell
+
+    # 拼写索引保存在本机临时目录里，文件名区分服务器和数据库，进程
+    # 重启以后只要指纹没变就直接使用
+    def __spell_name(self):
+        import tempfile
+        host = self.__uri.get('host', 'localhost')
+        port = self.__uri.get('port', 3306)
+        name = 'stardict-mysql-%s-%s-%s.spell' % (host, port, self.__db)
+        name = re.sub(r'[^\w.\-]', '_', name)
+        return os.path.join(tempfile.gettempdir(), name)
+
+    # 拼写索引的来源指纹：词条数量、最大 id 和 MyISAM 记录的修改时间
+    def __spell_source(self):
+        sql1 = 'SELECT count(*), max(id) FROM stardict;'
+        sql2 = 'SELECT UPDATE_TIME FROM information_schema.tables '
+        sql2 += "WHERE table_schema = DATABASE() AND table_name = 'stardict';"
+        try:
+            with self.__conn as c:
+                c.execute(sql1)
+                count, maxid = c.fetchone()
+                c.execute(sql2)
+                record = c.fetchone()
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            return None
+        return '%s:%s:%s' % (count, maxid, record and record[0] or None)
+
+    def __spell_rows(self):
+        sql = 'select word, sw, frq, bnc, collins from stardict;'
+        with self.__conn as c:
+            c.execute(sql)
+            while True:
+                rows = c.fetchmany(BATCH_ROWS)
+                if not rows:
+                    break
+                for word, sw, frq, bnc, collins in rows:
+                    yield word, sw, word_score(frq, bnc, collins)
+
 
 # ----------------------------------------------------------------------
 # CSV COLUMNS
@@ -639,11 +2819,218 @@ COLUMN_SD = COLUMN_SIZE + 1
 COLUMN_SW = COLUMN_SIZE + 2
 
 
+# ----------------------------------------------------------------------
+# csv index: DictCsv 的旁路索引文件 csvname.index，保存每一行在 csv 里
+# 的字节位置，按单词（word_collate）、(sw, 小写单词) 和小写单词排好的
+# 三种顺序，用 csv 的大小和修改时间校验。打开时 mmap 整个 csv，访问到
+# 某一行时才解析，打开几乎不花时间，内存只和访问过的行有关。要求每条
+# 记录占一行（DictCsv 保存时会转义换行），否则不建立索引
+# ----------------------------------------------------------------------
+CSV_INDEX_MAGIC = b'SDCI'
+CSV_INDEX_VERSION = 1
+CSV_INDEX_HEAD = '<4sIQdI16s'
+
+# 读取索引文件，csv 改动过或者索引不存在、损坏时返回 None
+def csv_index_open(csvname, codec='utf-8'):
+    name = csvname + '.index'
+    if not os.path.exists(name):
+        return None
+    try:
+        with open(name, 'rb') as fp:
+            head = fp.read(struct.calcsize(CSV_INDEX_HEAD))
+            magic, version, size, mtime, count, text = \
+                struct.unpack(CSV_INDEX_HEAD, head)
+            if magic != CSV_INDEX_MAGIC or version != CSV_INDEX_VERSION:
+                return None
+            if size != os.path.getsize(csvname):
+                return None
+            if mtime != os.path.getmtime(csvname):
+                return None
+            if text.rstrip(b'\0') != codec.encode('ascii'):
+                return None
+            orders = []
+            for i in xrange(3):
+                order = array.array('I')
+                order.fromfile(fp, count)
+                if sys.byteorder != 'little':
+                    order.byteswap()
+                orders.append(order)
+    except (IOError, OSError, EOFError, struct.error, ValueError):
+        return None
+    return CsvIndex(csvname, codec, *orders)
+
+# 解析整个 csv 生成索引文件，规则和 DictCsv 读取时相同：跳过表头和
+# 空行，同一个单词（忽略大小写）只保留第一次出现的
+def csv_index_build(csvname, codec='utf-8'):
+    total = os.path.getsize(csvname)
+    mtime = os.path.getmtime(csvname)
+    if total == 0 or total >= 0xffffffff or array.array('I').itemsize != 4:
+        return False
+    offsets = array.array('I')
+    words = []
+    current = [0]
+    fp = open(csvname, 'rb')
+    def lines():
+        offset = 0
+        for line in fp:
+            if line.count(b'"') % 2:
+                raise ValueError('record spans lines at %d' % offset)
+            current[0] = offset
+            offset += len(line)
+            if sys.version_info[0] < 3:
+                yield line
+            else:
+                yield line.decode(codec, 'ignore')
+    seen = set()
+    try:
+        count = 0
+        for row in csv.reader(lines()):
+            count += 1
+            if count == 1:
+                continue
+            if len(row) < 1:
+                continue
+            word = row[0]
+            if sys.version_info[0] < 3:
+                word = word.decode(codec, 'ignore')
+            key = word.lower()
+            if key in seen:
+                continue
+            seen.add(key)
+            offsets.append(current[0])
+            words.append(word)
+    except (ValueError, csv.Error):
+        return False
+    finally:
+        fp.close()
+    seen = None
+    # 行号按单词排好序就是 id
+    size = len(words)
+    keys = [word_collate(w) for w in words]
+    order = sorted(xrange(size), key=keys.__getitem__)
+    ids = array.array('I', [0]) * size
+    for i in xrange(size):
+        ids[order[i]] = i
+    offsets = array.array('I', [offsets[n] for n in order])
+    keys = [(stripword(w), w.lower()) for w in words]
+    order = sorted(xrange(size), key=keys.__getitem__)
+    sworder = array.array('I', [ids[n] for n in order])
+    keys = [w.lower() for w in words]
+    order = sorted(xrange(size), key=keys.__getitem__)
+    loworder = array.array('I', [ids[n] for n in order])
+    keys = order = ids = words = None
+    head = struct.pack(CSV_INDEX_HEAD, CSV_INDEX_MAGIC, CSV_INDEX_VERSION,
+                       total, mtime, size,
+                       codec.encode('ascii'))
+    name = csvname + '.index'
+    temp = name + '.tmp'
+    try:
+        with open(temp, 'wb') as fp:
+            fp.write(head)
+            for order in (offsets, sworder, loworder):
+                if sys.byteorder != 'little':
+                    order.byteswap()
+                order.tofile(fp)
+        if os.path.exists(name):
+            os.remove(name)
+        os.rename(temp, name)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+# 延迟解析的 csv：offsets 按 id 排列，sworder 和 loworder 为按
+# (sw, 小写单词) 和小写单词排好序的 id
+class CsvIndex(object):
+    def __init__(self, csvname, codec, offsets, sworder, loworder):
+        self.__codec = codec
+        self.__offsets = offsets
+        self.sworder = sworder
+        self.loworder = loworder
+        self.__fp = open(csvname, 'rb')
+        self.__mm = mmap.mmap(self.__fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.__offsets)
+
+    def close(self):
+        if self.__mm is not None:
+            self.__mm.close()
+            self.__fp.close()
+        self.__mm = None
+        self.__fp = None
+
+    # 解析 id 对应的行，格式和 DictCsv 内存里的行相同
+    def row(self, id, sd=0):
+        mm = self.__mm
+        start = self.__offsets[id]
+        end = mm.find(b'\n', start)
+        if end < 0:
+            end = len(mm)
+        line = mm[start:end + 1]
+        if sys.version_info[0] < 3:
+            row = next(csv.reader([line]))
+            row = [n.decode(self.__codec, 'ignore') for n in row]
+        else:
+            row = next(csv.reader([line.decode(self.__codec, 'ignore')]))
+        if len(row) < COLUMN_SIZE:
+            row.extend([None] * (COLUMN_SIZE - len(row)))
+        if len(row) > COLUMN_SIZE:
+            row = row[:COLUMN_SIZE]
+        row.extend([id, sd, stripword(row[0])])
+        return row
+
+    # 按单词（忽略大小写）查找，二分 loworder
+    def find(self, word):
+        key = word.lower()
+        order = self.loworder
+        top = 0
+        bottom = len(order)
+        while top < bottom:
+            middle = (top + bottom) >> 1
+            row = self.row(order[middle])
+            text = row[0].lower()
+            if text == key:
+                return row
+            elif text < key:
+                top = middle + 1
+            else:
+                bottom = middle
+        return None
+
+
+# 按某种顺序访问 CsvIndex 的只读行序列，代替 DictCsv 里的行表
+class CsvRows(object):
+    def __init__(self, index, order=None):
+        self.__index = index
+        self.__order = order
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self[i] for i in xrange(*pos.indices(len(self)))]
+        if pos < 0:
+            pos += len(self)
+        if pos < 0 or pos >= len(self):
+            raise IndexError(pos)
+        if self.__order is None:
+            return self.__index.row(pos)
+        return self.__index.row(self.__order[pos], pos)
+
+    def __iter__(self):
+        for pos in xrange(len(self)):
+            yield self[pos]
+
+
 # ----------------------------------------------------------------------
 # DictCsv
 # ----------------------------------------------------------------------
 class DictCsv(object):
-    def __init__(self, filename, codec='utf-8'):
+    # sidecar 为 True 时使用 csvname.index 索引文件，没有或者过期就重建，
+    # 为 None 时只使用已经存在并且有效的索引，为 False 时完整读入内存
+    def __init__(self, filename, codec='utf-8', sidecar=None):
         self.__csvname = None
         if filename is not None:
             self.__csvname = os.path.abspath(filename)
@@ -661,6 +3048,12 @@ class DictCsv(object):
             numbers.append(self.__names[name])
         self.__numbers = tuple(numbers)
         self.__enable = self.__fields[1:]
+        self.__projects = {}
+        self.__spell = None
+        self.__sidecar = sidecar
+        self.__lazy = None
+        self.__stamp = None
+        self.__changes = 0
         self.__dirty = False
         self.__words = {}
         self.__rows = []
@@ -668,6 +3061,9 @@ class DictCsv(object):
         self.__read()
 
     def reset(self):
+        if self.__lazy is not None:
+            self.__lazy.close()
+        self.__lazy = None
         self.__dirty = False
         self.__words = {}
         self.__rows = []
@@ -685,6 +3081,8 @@ class DictCsv(object):
         i = 0
         if text is None:
             return None
+        if '\\' not in text:
+            return text
         size = len(text)
         while i < size:
             c = text[i]
@@ -718,15 +3116,35 @@ class DictCsv(object):
             return int(x)
         return x
 
-    # 读取文件
-    def __read(self):
+    # 关闭文件
+    def close(self):
+        self.reset()
+        if self.__spell:
+            self.__spell.close()
+        self.__spell = None
+
+    # 读取文件，有可用的索引时只 mmap 文件，行在访问时才解析
+    def __read(self, lazy=True):
         self.reset()
+        self.__stamp = None
         filename = self.__csvname
         if filename is None:
             return False
         if not os.path.exists(self.__csvname):
             return False
         codec = self.__codec
+        self.__stamp = '%d:%r' % (os.path.getsize(filename),
+                                  os.path.getmtime(filename))
+        if lazy and self.__sidecar is not False:
+            index = csv_index_open(filename, codec)
+            if index is None and self.__sidecar:
+                if csv_index_build(filename, codec):
+                    index = csv_index_open(filename, codec)
+            if index is not None:
+                self.__lazy = index
+                self.__rows = CsvRows(index)
+                self.__index = CsvRows(index, index.sworder)
+                return True
         if sys.version_info[0] < 3:
             fp = open(filename, 'rb')
             content = fp.read()
@@ -765,7 +3183,7 @@ class DictCsv(object):
             index.append(row)
         self.__rows = rows
         self.__index = index
-        self.__rows.sort(key=lambda row: row[0].lower())
+        self.__rows.sort(key=lambda row: word_collate(row[0]))
         self.__index.sort(key=lambda row: (row[COLUMN_SW], row[0].lower()))
         for index in xrange(len(self.__rows)):
             row = self.__rows[index]
@@ -778,12 +3196,19 @@ class DictCsv(object):
             row[COLUMN_SD] = index
         return True
 
-    # 保存文件
+    # 延迟解析的文件在修改或者保存以前完整读入内存
+    def __load(self):
+        if self.__lazy is not None:
+            self.__read(False)
+        return True
+
+    # 保存文件，使用索引文件时顺便重建索引
     def save(self, filename=None, codec='utf-8'):
         if filename is None:
             filename = self.__csvname
         if filename is None:
             return False
+        self.__load()
         if sys.version_info[0] < 3:
             fp = open(filename, 'wb')
             writer = csv.writer(fp)
@@ -802,32 +3227,81 @@ class DictCsv(object):
                 newrow.append(n)
             writer.writerow(newrow[:COLUMN_SIZE])
         fp.close()
+        if self.__sidecar and filename == self.__csvname:
+            csv_index_build(filename, codec)
         return True
 
-    # 对象解码
-    def __obj_decode(self, row):
+    # 把 (word, items) 序列按顺序直接写成 csv 文件，不经过内存里的行表，
+    # records 需要已经按单词（忽略大小写）排好序并且没有重复。position
+    # 不为 None 时是续传：文件截断到 position 字节处接着写，不再写表头。
+    # checkpoint 不为 None 时每写 BULK_ROWS 行把数据刷到文件里，然后调用
+    # checkpoint(word, offset) 报告已经写完的最后一个单词和文件长度
+    def export(self, filename, records, codec='utf-8', position=None,
+               checkpoint=None):
+        if position is None:
+            fp = open(filename, 'wb')
+        else:
+            fp = open(filename, 'r+b')
+            fp.seek(position)
+            fp.truncate()
+        out = fp
+        if sys.version_info[0] >= 3:
+            out = io.TextIOWrapper(fp, encoding=codec)
+        writer = csv.writer(out)
+        if position is None:
+            writer.writerow(self.__heads)
+        count = 0
+        for word, items in records:
+            row = self.__obj_encode(items)
+            row[0] = word
+            newrow = []
+            for n in row[:COLUMN_SIZE]:
+                if (n is not None) and sys.version_info[0] < 3:
+                    n = n.encode(codec, 'ignore')
+                newrow.append(n)
+            writer.writerow(newrow)
+            count += 1
+            if checkpoint is not None and count % BULK_ROWS == 0:
+                out.flush()
+                fp.flush()
+                os.fsync(fp.fileno())
+                checkpoint(word, fp.tell())
+        out.close()
+        return count
+
+    # 字段投影，记录布局缓存起来
+    def __layout(self, fields):
+        key = None
+        if fields is not None:
+            key = tuple(fields)
+        layout = self.__projects.get(key, None)
+        if layout is None:
+            layout = field_projection(fields)[1]
+            self.__projects[key] = layout
+        return layout
+
+    # 对象解码，fields 不为 None 时只解码需要的字段，detail 访问时再解码
+    def __obj_decode(self, row, fields=None):
         if row is None:
             return None
-        obj = {}
-        obj['id'] = row[COLUMN_ID]
-        obj['sw'] = row[COLUMN_SW]
+        layout = self.__layout(fields)
         skip = self.__numbers
-        for key, index in self.__fields:
-            value = row[index]
-            if index in skip:
-                if value is not None:
-                    value = self.readint(value)
-            elif key != 'detail':
-                value = self.decode(value)
-            obj[key] = value
-        detail = obj.get('detail', None)
-        if detail is not None:
-            if detail != '':
-                detail = json.loads(detail)
+        values = []
+        for key in layout[0]:
+            if key == 'id':
+                value = row[COLUMN_ID]
+            elif key == 'sw':
+                value = row[COLUMN_SW]
             else:
-                detail = None
-        obj['detail'] = detail
-        return obj
+                index = self.__names[key]
+                value = row[index]
+                if index in skip:
+                    if value is not None:
+                        value = self.readint(value)
+                elif key != 'detail':
+                    value = self.decode(value)
+            values.append(value)
+        return DictRecord(layout, values)
 
     # 对象编码
     def __obj_encode(self, obj):
@@ -847,7 +3321,7 @@ class DictCsv(object):
 
     # 重新排序
     def __resort(self):
-        self.__rows.sort(key=lambda row: row[0].lower())
+        self.__rows.sort(key=lambda row: word_collate(row[0]))
         self.__index.sort(key=lambda row: (row[COLUMN_SW], row[0].lower()))
         for index in xrange(len(self.__rows)):
             row = self.__rows[index]
@@ -858,7 +3332,7 @@ class DictCsv(object):
         self.__dirty = False
 
     # 查询单词
-    def query(self, key):
+    def query(self, key, fields=None):
         if key is None:
             return None
         if self.__dirty:
@@ -866,9 +3340,11 @@ class DictCsv(object):
         if isinstance(key, int) or isinstance(key, long):
             if key < 0 or key >= len(self.__rows):
                 return None
-            return self.__obj_decode(self.__rows[key])
+            return self.__obj_decode(self.__rows[key], fields)
+        if self.__lazy is not None:
+            return self.__obj_decode(self.__lazy.find(key), fields)
         row = self.__words.get(key.lower(), None)
-        return self.__obj_decode(row)
+        return self.__obj_decode(row, fields)
 
     # 查询单词匹配
     def match(self, word, count=10, strip=False):
@@ -886,21 +3362,21 @@ class DictCsv(object):
         top = 0
         bottom = len(index) - 1
         middle = top
-        key = word.lower()
+        key = word_collate(word)
         if strip:
             key = stripword(word)
         while top < bottom:
             middle = (top + bottom) >> 1
             if top == middle or bottom == middle:
                 break
-            text = index[middle][pos].lower()
+            text = word_collate(index[middle][pos])
             if key == text:
                 break
             elif key < text:
                 bottom = middle
             elif key > text:
                 top = middle
-        while index[middle][pos].lower() < key:
+        while word_collate(index[middle][pos]) < key:
             middle += 1
             if middle >= len(index):
                 break
@@ -908,9 +3384,17 @@ class DictCsv(object):
         likely = [(tx[cc], tx[0]) for tx in index[middle:middle + count]]
         return likely
 
+    # 查询单词匹配，直接返回匹配到的记录
+    def match_rows(self, word, limit=10, strip=False, fields=None):
+        rows = self.__rows
+        result = []
+        for index, _ in self.match(word, limit, strip):
+            result.append(self.__obj_decode(rows[index], fields))
+        return result
+
     # 批量查询
-    def query_batch(self, keys):
-        return [self.query(key) for key in keys]
+    def query_batch(self, keys, fields=None):
+        return [self.query(key, fields) for key in keys]
 
     # 单词总量
     def count(self):
@@ -926,17 +3410,40 @@ class DictCsv(object):
 
     # 是否存在
     def __contains__(self, key):
+        if self.__lazy is not None:
+            return self.__lazy.find(key) is not None
         return self.__words.__contains__(key.lower())
 
     # 迭代器
     def __iter__(self):
-        record = []
-        for index in xrange(len(self.__rows)):
-            record.append((index, self.__rows[index][0]))
-        return record.__iter__()
+        if self.__dirty:
+            self.__resort()
+        rows = self.__rows
+        for index in xrange(len(rows)):
+            yield (index, rows[index][0])
+
+    # 按单词顺序逐条返回 fields 指定字段的记录，从 start_after 之后开始，
+    # 行本来就按 word_collate 排好序，二分查找起点
+    def iter_rows(self, batch_size=BATCH_ROWS, fields=None, start_after=None):
+        if self.__dirty:
+            self.__resort()
+        rows = self.__rows
+        start = 0
+        if start_after is not None:
+            key = word_collate(start_after)
+            top = len(rows)
+            while start < top:
+                middle = (start + top) // 2
+                if word_collate(rows[middle][0]) <= key:
+                    start = middle + 1
+                else:
+                    top = middle
+        for index in xrange(start, len(rows)):
+            yield self.__obj_decode(rows[index], fields)
 
     # 注册新单词
     def register(self, word, items, commit=True):
+        self.__load()
         if word.lower() in self.__words:
             return False
         row = self.__obj_encode(items)
@@ -948,10 +3455,37 @@ class DictCsv(object):
         self.__index.append(row)
         self.__words[word.lower()] = row
         self.__dirty = True
+        self.__changes += 1
         return True
 
+    # 批量注册新单词，全部插入以后只排序一次
+    def register_many(self, records, commit=True):
+        return self.__write_many(records, False)
+
+    # 批量写入：不存在的注册，存在的更新 items 里给出的字段
+    def upsert_many(self, records, commit=True):
+        return self.__write_many(records, True)
+
+    def __write_many(self, records, upsert):
+        ts = time.time()
+        self.__load()
+        count = 0
+        changes = 0
+        for word, items in records:
+            count += 1
+            if word.lower() not in self.__words:
+                if self.register(word, items):
+                    changes += 1
+            elif upsert:
+                if self.update(word, items):
+                    changes += 1
+        if self.__dirty:
+            self.__resort()
+        return batch_report(count, changes, ts)
+
     # 删除单词
     def remove(self, key, commit=True):
+        self.__load()
         if isinstance(key, int) or isinstance(key, long):
             if key < 0 or key >= len(self.__rows):
                 return False
@@ -963,6 +3497,7 @@ class DictCsv(object):
             return False
         if len(self.__rows) == 1:
             self.reset()
+            self.__changes += 1
             return True
         index = row[COLUMN_ID]
         self.__rows[index] = self.__rows[len(self.__rows) - 1]
@@ -972,15 +3507,18 @@ class DictCsv(object):
         self.__index.pop()
         del self.__words[key]
         self.__dirty = True
+        self.__changes += 1
         return True
 
     # 清空所有
     def delete_all(self, reset_id=False):
         self.reset()
+        self.__changes += 1
         return True
 
     # 更改单词
     def update(self, key, items, commit=True):
+        self.__load()
         if isinstance(key, int) or isinstance(key, long):
             if key < 0 or key >= len(self.__rows):
                 return False
@@ -997,6 +3535,7 @@ class DictCsv(object):
                 continue
             if name in items:
                 row[idx] = newrow[idx]
+        self.__changes += 1
         return True
 
     # 提交变更
@@ -1009,6 +3548,579 @@ class DictCsv(object):
     def dumps(self):
         return [n for _, n in self.__iter__()]
 
+    # 拼写建议（did you mean）：返回 [(word, distance), ...]
+    def suggest(self, word, max_distance=SPELL_DISTANCE, limit=10):
+        speller = self.__speller()
+        if speller is None:
+            return None
+        return speller.suggest(word, max_distance, limit)
+
+    # 重建拼写建议索引
+    def spell_rebuild(self):
+        return self.__speller(True) is not None
+
+    # 打开拼写索引，词典指纹和建立时不一致就重建
+    def __speller(self, rebuild=False):
+        if self.__spell is None:
+            self.__spell = SpellIndex(self.__spell_name())
+        source = self.__spell_source()
+        if rebuild or self.__spell.source() != source:
+            self.__spell.build(self.__spell_rows(), source)
+        return self.__spell
+
+    # 拼写索引的来源指纹：读入时 csv 的大小和修改时间，词条数量和内存
+    # 里的改动次数。有未保存的改动时再加上进程和对象，避免别的进程用
+    # 同一个 .spell 文件时误判
+    def __spell_source(self):
+        source = '%s:%d:%d' % (self.__stamp, self.count(), self.__changes)
+        if self.__changes:
+            source += ':%d:%d' % (os.getpid(), id(self))
+        return source
+
+    def __spell_name(self):
+        if self.__csvname is None:
+            return ':memory:'
+        return self.__csvname + '.spell'
+
+    def __spell_rows(self):
+        names = self.__names
+        readint = self.readint
+        for row in self.__rows:
+            frq = readint(row[names['frq']])
+            bnc = readint(row[names['bnc']])
+            collins = readint(row[names['collins']])
+            yield row[0], row[COLUMN_SW], word_score(frq, bnc, collins)
+
+
+# ----------------------------------------------------------------------
+# csv import: 并行导入 DictCsv 格式的 csv 文件。DictCsv 保存时把字段里
+# 的换行转义成 \n，所以每一行就是一条记录，可以按行边界切块，每块由
+# 一个进程独立解析成可以直接写入 stardict 表的行
+# ----------------------------------------------------------------------
+CSV_CHUNK = 4 * 1024 * 1024
+
+# 把文件切成大约 size 字节的块，边界总在行首，返回 [(start, end), ...]，
+# start 为续传时的起始位置，必须在行首
+def csv_split(filename, size=CSV_CHUNK, start=0):
+    total = os.path.getsize(filename)
+    offsets = [start]
+    fp = open(filename, 'rb')
+    pos = start + size
+    while pos < total:
+        fp.seek(pos)
+        fp.readline()
+        pos = fp.tell()
+        if pos >= total:
+            break
+        offsets.append(pos)
+        pos += size
+    fp.close()
+    offsets.append(total)
+    return [(offsets[i], offsets[i + 1]) for i in xrange(len(offsets) - 1)]
+
+# 导入时写入的列：word, sw, csv 的其余字段，最后是派生列
+def csv_import_columns():
+    heads = ('phonetic', 'definition', 'translation', 'pos', 'collins',
+             'oxford', 'tag', 'bnc', 'frq', 'exchange', 'detail', 'audio')
+    names = ('word', 'sw') + heads + tuple([n for n, _, _ in DERIVED_COLUMNS])
+    return names, heads
+
+# 解析一块，task 为 (filename, start, end, codec)，第一块跳过表头，
+# 字段的解码和 DictCsv 读取时相同，oxford/collins 的处理和 convert_dict
+# 相同，返回按 csv_import_columns 排列的行
+def csv_import_chunk(task):
+    filename, start, end, codec = task
+    fp = open(filename, 'rb')
+    fp.seek(start)
+    content = fp.read(end - start)
+    fp.close()
+    if sys.version_info[0] < 3:
+        content = content.replace(b'\r\n', b'\n')
+        reader = csv.reader(io.BytesIO(content))
+    else:
+        reader = csv.reader(io.StringIO(content.decode(codec, 'ignore')))
+    helper = DictCsv(None, codec)
+    names, heads = csv_import_columns()
+    numbers = ('collins', 'oxford', 'bnc', 'frq')
+    rows = []
+    skip = (start == 0)
+    for row in reader:
+        if skip:
+            skip = False
+            continue
+        if len(row) < 1:
+            continue
+        if sys.version_info[0] < 3:
+            row = [n.decode(codec, 'ignore') for n in row]
+        if len(row) < COLUMN_SIZE:
+            row.extend([None] * (COLUMN_SIZE - len(row)))
+        values = {'word': helper.decode(row[0]), 'sw': stripword(row[0])}
+        for i in xrange(len(heads)):
+            name = heads[i]
+            value = row[i + 1]
+            if name in numbers:
+                value = helper.readint(value)
+            elif name == 'detail':
+                value = value or None
+            else:
+                value = helper.decode(value)
+            values[name] = value
+        convert_record(values)
+        for name, value in derived_values(values):
+            values[name] = value
+        rows.append(tuple([values[n] for n in names]))
+    return rows
+
+
+# ----------------------------------------------------------------------
+# DictCache: 放在任意词典前面的 LRU 查询缓存，大小写不敏感，
+# 通过它进行的 register/update/remove/delete_all 会精确失效对应条目，
+# bulk_load/bulk_import/sync/reset 清空整个缓存。每次失效都增加代数，
+# 后端读取期间代数变了的结果不写入缓存，避免把旧数据放回去
+# ----------------------------------------------------------------------
+DICT_CACHE_SIZE = 4096
+
+class DictCache(object):
+    def __init__(self, dictionary, size=DICT_CACHE_SIZE, ttl=None):
+        self.__dict = dictionary
+        self.__size = max(1, size)
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__cache = collections.OrderedDict()
+        self.__ids = {}
+        self.__generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    # 清空缓存
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+            self.__ids.clear()
+            self.__generation += 1
+        return True
+
+    # 统计数据
+    def stats(self):
+        with self.__lock:
+            size = len(self.__cache)
+        return {'size': size, 'capacity': self.__size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expired': self.expired}
+
+    # 取出缓存项，miss 时返回 (False, None)
+    def __lookup(self, key):
+        with self.__lock:
+            if isinstance(key, int) or isinstance(key, long):
+                name = self.__ids.get(key, None)
+            else:
+                name = key.lower()
+            item = (name is not None) and self.__cache.get(name) or None
+            if item is None:
+                self.misses += 1
+                return False, None
+            ts, obj = item
+            if self.__ttl is not None and time.time() - ts > self.__ttl:
+                self.__drop(name)
+                self.expired += 1
+                self.misses += 1
+                return False, None
+            # 挪到队尾，作为最近使用
+            del self.__cache[name]
+            self.__cache[name] = item
+            self.hits += 1
+        if obj is not None:
+            obj = obj.copy()
+        return True, obj
+
+    # 写入缓存项，未找到的单词也缓存（记为 None），整数 id 的 miss 不缓存，
+    # generation 为读取后端之前的代数，之后有过失效时放弃写入
+    def __store(self, key, obj, generation):
+        if obj is None:
+            if isinstance(key, int) or isinstance(key, long):
+                return False
+            name = key.lower()
+        else:
+            name = obj['word'].lower()
+            obj = obj.copy()
+        with self.__lock:
+            if generation != self.__generation:
+                return False
+            self.__drop(name)
+            self.__cache[name] = (time.time(), obj)
+            if obj is not None:
+                self.__ids[obj['id']] = name
+            while len(self.__cache) > self.__size:
+                self.__drop(next(iter(self.__cache)))
+                self.evictions += 1
+        return True
+
+    # 删除缓存项，需要持有锁
+    def __drop(self, name):
+        item = self.__cache.pop(name, None)
+        if item is not None and item[1] is not None:
+            self.__ids.pop(item[1]['id'], None)
+        return item
+
+    # 让某个 id 或者单词的缓存失效
+    def invalidate(self, key):
+        with self.__lock:
+            if isinstance(key, int) or isinstance(key, long):
+                name = self.__ids.get(key, None)
+            else:
+                name = key.lower()
+            if name is not None:
+                self.__drop(name)
+            self.__generation += 1
+        return True
+
+    # 查询单词，指定 fields 时命中则从完整记录里投影，未命中不写入缓存
+    def query(self, key, fields=None):
+        if key is None:
+            return None
+        generation = self.__generation
+        found, obj = self.__lookup(key)
+        if found:
+            if fields is not None and obj is not None:
+                layout = field_projection(fields)[1]
+                values = [obj[k] for k in layout[0]]
+                detail = obj.get('detail', None)
+                obj = DictRecord(layout, values, detail)
+            return obj
+        if fields is not None:
+            return self.__dict.query(key, fields)
+        obj = self.__dict.query(key)
+        self.__store(key, obj, generation)
+        return obj
+
+    # 批量查询，只把缓存里没有的单词交给后端
+    def query_batch(self, keys, fields=None):
+        if fields is not None:
+            return self.__dict.query_batch(keys, fields)
+        if keys is None:
+            return None
+        if not keys:
+            return []
+        generation = self.__generation
+        results = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if key is None:
+                continue
+            found, obj = self.__lookup(key)
+            if found:
+                results[i] = obj
+            else:
+                missing.append(i)
+        if missing:
+            objs = self.__dict.query_batch([keys[i] for i in missing])
+            for i, obj in zip(missing, objs):
+                self.__store(keys[i], obj, generation)
+                results[i] = obj
+        return tuple(results)
+
+    def match(self, word, limit=10, strip=False):
+        return self.__dict.match(word, limit, strip)
+
+    # DictCsv 的 id 是排序后的行号，增删单词后所有 id 都会变化
+    def register(self, word, items, commit=True):
+        if isinstance(self.__dict, DictCsv):
+            self.clear()
+        self.invalidate(word)
+        hr = self.__dict.register(word, items, commit)
+        if isinstance(self.__dict, DictCsv):
+            self.clear()
+        self.invalidate(word)
+        return hr
+
+    def register_many(self, records, commit=True):
+        records = list(records)
+        self.__invalidate_many(records)
+        hr = self.__dict.register_many(records, commit)
+        self.__invalidate_many(records)
+        return hr
+
+    def upsert_many(self, records, commit=True):
+        records = list(records)
+        self.__invalidate_many(records)
+        hr = self.__dict.upsert_many(records, commit)
+        self.__invalidate_many(records)
+        return hr
+
+    def __invalidate_many(self, records):
+        if isinstance(self.__dict, DictCsv):
+            return self.clear()
+        for word, _ in records:
+            self.invalidate(word)
+        return True
+
+    def update(self, key, items, commit=True):
+        self.invalidate(key)
+        hr = self.__dict.update(key, items, commit)
+        self.invalidate(key)
+        return hr
+
+    def remove(self, key, commit=True):
+        self.invalidate(key)
+        hr = self.__dict.remove(key, commit)
+        if isinstance(self.__dict, DictCsv):
+            self.clear()
+        self.invalidate(key)
+        return hr
+
+    def delete_all(self, reset_id=False):
+        self.clear()
+        hr = self.__dict.delete_all(reset_id)
+        self.clear()
+        return hr
+
+    # 批量改写后端的接口，不知道具体改了哪些单词，整个缓存清空
+    def bulk_load(self, *args, **kwargs):
+        self.clear()
+        hr = self.__dict.bulk_load(*args, **kwargs)
+        self.clear()
+        return hr
+
+    def bulk_import(self, *args, **kwargs):
+        self.clear()
+        hr = self.__dict.bulk_import(*args, **kwargs)
+        self.clear()
+        return hr
+
+    def sync(self, records):
+        self.clear()
+        hr = self.__dict.sync(records)
+        self.clear()
+        return hr
+
+    def reset(self):
+        self.clear()
+        hr = self.__dict.reset()
+        self.clear()
+        return hr
+
+    # 提交失败时事务被回滚，缓存里可能有未提交的数据
+    def commit(self):
+        hr = self.__dict.commit()
+        if not hr:
+            self.clear()
+        return hr
+
+    # 其他接口直接转发给后端词典
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.__dict, name)
+
+    def __iter__(self):
+        return self.__dict.__iter__()
+
+    def __len__(self):
+        return self.__dict.__len__()
+
+    def __contains__(self, key):
+        return self.query(key) is not None
+
+    def __getitem__(self, key):
+        return self.query(key)
+
+
+# ----------------------------------------------------------------------
+# SpellIndex: 拼写建议，SymSpell 的删除邻域索引：每个词条（sw 形式）
+# 预先生成删掉至多 SPELL_DISTANCE 个字母的所有变体，查询时对输入做同样
+# 的删除，命中相同变体的词条再计算真实编辑距离。只对前 SPELL_PREFIX
+# 个字母生成变体，索引保存成词典旁边的 SQLite 文件
+# ----------------------------------------------------------------------
+
+# 编辑距离（相邻交换算一次编辑），超过 limit 时提前返回 limit + 1
+def edit_distance(s1, s2, limit=None):
+    n1 = len(s1)
+    n2 = len(s2)
+    if limit is not None and abs(n1 - n2) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(n2 + 1))
+    for i in xrange(1, n1 + 1):
+        current = [i] + [0] * n2
+        best = i
+        for j in xrange(1, n2 + 1):
+            cost = (s1[i - 1] != s2[j - 1]) and 1 or 0
+            value = min(prev[j] + 1, current[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1:
+                if s1[i - 1] == s2[j - 2] and s1[i - 2] == s2[j - 1]:
+                    value = min(value, prev2[j - 2] + 1)
+            current[j] = value
+            if value < best:
+                best = value
+        if limit is not None and best > limit:
+            return limit + 1
+        prev2 = prev
+        prev = current
+    return prev[n2]
+
+# 删掉至多 distance 个字母的所有变体（包括原词，不包括空串）
+def spell_deletes(term, distance):
+    result = {term: 1}
+    queue = [term]
+    for n in xrange(distance):
+        following = []
+        for text in queue:
+            if len(text) <= 1:
+                continue
+            for i in xrange(len(text)):
+                key = text[:i] + text[i + 1:]
+                if key not in result:
+                    result[key] = 1
+                    following.append(key)
+        queue = following
+    return list(result.keys())
+
+
+class SpellIndex(object):
+    def __init__(self, filename, verbose=False):
+        self.__filename = filename
+        if filename != ':memory:':
+            self.__filename = os.path.abspath(filename)
+        self.__verbose = verbose
+        self.__conn = None
+        self.__meta = {}
+        self.__open()
+
+    def __open(self):
+        self.__conn = sqlite3.connect(self.__filename, check_same_thread=False)
+        self.__meta = {}
+        try:
+            c = self.__conn.cursor()
+            c.execute('select name, value from meta;')
+            for name, value in c.fetchall():
+                self.__meta[name] = value
+        except sqlite3.Error:
+            pass
+        return True
+
+    def close(self):
+        if self.__conn:
+            self.__conn.close()
+        self.__conn = None
+
+    def __del__(self):
+        self.close()
+
+    def out(self, text):
+        if self.__verbose:
+            print(text)
+        return True
+
+    # 索引是否已经建立
+    def ready(self):
+        return 'distance' in self.__meta
+
+    # 建立索引时记录的来源词典指纹（字符串），用于判断是否过期
+    def source(self):
+        return self.__meta.get('source', None)
+
+    # 建立索引，rows 为 (word, sw, score) 序列，score 越小越常用，
+    # 先写到临时文件，完成以后再替换，建立过程中旧索引仍然可用
+    def build(self, rows, source=None, distance=SPELL_DISTANCE,
+              prefix=SPELL_PREFIX):
+        sql = '''
+		CREATE TABLE terms (
+			"id" INTEGER PRIMARY KEY NOT NULL,
+			"term" VARCHAR(64) NOT NULL,
+			"word" VARCHAR(64) NOT NULL,
+			"score" INTEGER NOT NULL
+		);
+		CREATE TABLE deletes ("key" VARCHAR(64) NOT NULL, "id" INTEGER NOT NULL);
+		CREATE TABLE meta ("name" VARCHAR(16) PRIMARY KEY, "value" TEXT);
+		'''
+        sql = '\n'.join([n.strip('\t') for n in sql.split('\n')])
+        terms = {}
+        for word, sw, score in rows:
+            if not sw:
+                continue
+            item = terms.get(sw, None)
+            if item is None or (score, word) < item:
+                terms[sw] = (score, word)
+        memory = (self.__filename == ':memory:')
+        if memory:
+            self.close()
+            filename = ':memory:'
+        else:
+            filename = self.__filename + '.tmp'
+            if os.path.exists(filename):
+                os.remove(filename)
+        conn = sqlite3.connect(filename, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = OFF;')
+        conn.execute('PRAGMA synchronous = OFF;')
+        conn.executescript(sql.strip('\n'))
+        output = []
+        insert = 'INSERT INTO deletes VALUES (?, ?);'
+        index = 0
+        for term in sorted(terms):
+            index += 1
+            score, word = terms[term]
+            conn.execute('INSERT INTO terms VALUES (?, ?, ?, ?);',
+                         (index, term, word, score))
+            for key in spell_deletes(term[:prefix], distance):
+                output.append((key, index))
+            if len(output) >= BATCH_ROWS * 10:
+                conn.executemany(insert, output)
+                output = []
+        conn.executemany(insert, output)
+        conn.execute('CREATE INDEX deletes_1 ON deletes (key);')
+        if source is None:
+            source = len(terms)
+        meta = {'distance': distance, 'prefix': prefix, 'source': source}
+        for name, value in meta.items():
+            conn.execute('INSERT INTO meta VALUES (?, ?);', (name, str(value)))
+        conn.commit()
+        if memory:
+            self.__conn = conn
+        else:
+            conn.close()
+            self.close()
+            if os.path.exists(self.__filename):
+                os.remove(self.__filename)
+            os.rename(filename, self.__filename)
+            self.__conn = None
+        self.__meta = {}
+        for name, value in meta.items():
+            self.__meta[name] = str(value)
+        if self.__conn is None:
+            self.__open()
+        self.out('spell index: %d terms' % len(terms))
+        return True
+
+    # 拼写建议：返回 [(word, distance), ...]，按编辑距离和常用度排序
+    def suggest(self, word, max_distance=SPELL_DISTANCE, limit=10):
+        if not self.ready():
+            return None
+        term = stripword(word)
+        if not term:
+            return []
+        max_distance = min(max_distance, int(self.__meta['distance']))
+        prefix = int(self.__meta['prefix'])
+        keys = spell_deletes(term[:prefix], max_distance)
+        seen = {}
+        found = []
+        c = self.__conn.cursor()
+        for pos in xrange(0, len(keys), BATCH_CHUNK):
+            chunk = keys[pos:pos + BATCH_CHUNK]
+            sql = 'select distinct t.id, t.term, t.word, t.score from deletes d '
+            sql += 'join terms t on t.id = d.id where d.key in (%s);'
+            c.execute(sql % ','.join(['?'] * len(chunk)), tuple(chunk))
+            for id, text, name, score in c:
+                if id in seen:
+                    continue
+                seen[id] = 1
+                distance = edit_distance(term, text, max_distance)
+                if distance <= max_distance:
+                    found.append((distance, score, name))
+        found.sort()
+        return [(name, distance) for distance, score, name in found[:limit]]
+
 
 # ----------------------------------------------------------------------
 # 词形衍生：查找动词的各种时态，名词的复数等，或反向查找
@@ -1220,7 +4332,7 @@ class DictHelper(object):
             def next(self):
                 if self.total:
                     self.count += 1
-                    pc = self.count * 100 / self.total
+                    pc = self.count * 100 // self.total
                     if pc != self.percent:
                         self.percent = pc
                         print('progress: %d%%' % pc)
@@ -1250,17 +4362,35 @@ class DictHelper(object):
             words[word] = 1
         return words
 
-    # 字典差异导出
+    # 按 word_collate 顺序返回词典的 (word, record)，StarDict 和 DictCsv
+    # 本来就是这个顺序，DictMySQL 的排序规则不同，只能取出来排序
+    def __ordered(self, dictionary, fields=None):
+        if isinstance(dictionary, (StarDict, DictCsv)):
+            rows = dictionary.iter_rows(fields=fields)
+        else:
+            rows = sorted(dictionary.iter_rows(fields=fields),
+                          key=lambda row: word_collate(row['word']))
+        for row in rows:
+            yield row['word'], row
+
+    # 字典差异导出：words 排序后和词典归并，不需要把词典读进内存
     def discrepancy_export(self, dictionary, words, outname, opts=''):
-        existence = self.dump_map(dictionary)
         if os.path.splitext(outname)[-1].lower() in ('.txt', '.csv'):
             db = DictCsv(outname)
         else:
             db = StarDict(outname)
         db.delete_all()
+        def candidates():
+            last = None
+            for word in sorted(words, key=word_collate):
+                key = word_collate(word)
+                if key != last:
+                    last = key
+                    yield word, None
         count = 0
-        for word in words:
-            if word.lower() in existence:
+        existence = self.__ordered(dictionary, ())
+        for word, data, exist in merge_join(candidates(), existence):
+            if data is None or exist is not None:
                 continue
             if '(' in word:
                 continue
@@ -1289,42 +4419,61 @@ class DictHelper(object):
         print('exported %d entries' % count)
         return count
 
-    # 字典差异导入
+    # 字典差异导入：差异文件和词典归并，已有的单词直接更新，新单词
+    # 等归并结束以后再注册，避免改变正在遍历的词典
     def discrepancy_import(self, dictionary, filename, opts=''):
-        existence = self.dump_map(dictionary)
         if os.path.splitext(filename)[-1].lower() in ('.csv', '.txt'):
             db = DictCsv(filename)
         else:
-            db = StarDict(outname)
+            db = StarDict(filename)
+        fields = ('tag', 'phonetic', 'definition', 'translation')
         count = 0
-        for word in self.dump_map(db, False):
-            data = db[word]
+        pending = []
+        source = self.__ordered(db, fields)
+        existence = self.__ordered(dictionary, ())
+        for word, data, exist in merge_join(source, existence):
             if data is None:
                 continue
+            data = data[1]
             if data['tag'] != 'OK':
                 continue
-            phonetic = data.get('phonetic', '')
-            definition = data.get('definition', '')
-            translation = data.get('translation', '')
             update = {}
-            if phonetic:
-                update['phonetic'] = phonetic
-            if definition:
-                update['definition'] = definition
-            if translation:
-                update['translation'] = translation
+            for name in fields[1:]:
+                if data[name]:
+                    update[name] = data[name]
             if not update:
                 continue
-            if word.lower() in existence:
+            if exist is not None:
                 if not 'n' in opts:
-                    dictionary.update(word, update, False)
+                    dictionary.update(exist[0], update, False)
             else:
-                dictionary.register(word, update, False)
+                pending.append((word, update))
             count += 1
+        for word, update in pending:
+            dictionary.register(word, update, False)
         dictionary.commit()
         print('imported %d entries' % count)
         return count
 
+    # 逐字段比较两个词典，按单词顺序生成 (word, left, right, names)，
+    # names 为值不同的字段，只在一边出现的单词另一边为 None。fields 为
+    # 需要比较的字段，默认比较全部内容字段
+    def discrepancy_diff(self, left, right, fields=None):
+        if fields is None:
+            fields = HASH_FIELDS[1:]
+        names = tuple([n for n in fields if n not in ('id', 'word')])
+        source = self.__ordered(left, names)
+        target = self.__ordered(right, names)
+        for word, a, b in merge_join(source, target):
+            if a is None or b is None:
+                yield word, a and a[1], b and b[1], ()
+                continue
+            x = record_values(a[1], names)
+            y = record_values(b[1], names)
+            diff = tuple([names[i] for i in xrange(len(names)) if x[i] != y[i]])
+            if diff:
+                yield word, a[1], b[1], diff
+
     # 差异比较（utf-8 的.txt 文件，单词和后面音标释义用tab分割）
     def deficit_tab_txt(self, dictionary, txt, outname, opts=''):
         deficit = {}
@@ -1740,44 +4889,154 @@ class DictHelper(object):
 tools = DictHelper()
 
 
-# 根据文件名自动判断数据库类型并打开
-def open_dict(filename):
+# 根据文件名判断数据库类型：'mysql', 'csv' 或者 'sqlite'
+def dict_type(filename):
     if isinstance(filename, dict):
-        return DictMySQL(filename)
+        return 'mysql'
     if filename[:8] == 'mysql://':
-        return DictMySQL(filename)
+        return 'mysql'
     if os.path.splitext(filename)[-1].lower() in ('.csv', '.txt'):
+        return 'csv'
+    return 'sqlite'
+
+
+# 根据文件名自动判断数据库类型并打开
+def open_dict(filename):
+    kind = dict_type(filename)
+    if kind == 'mysql':
+        return DictMySQL(filename)
+    if kind == 'csv':
         return DictCsv(filename)
     return StarDict(filename)
 
 
-# 字典转化，csv sqlite之间互转
-def convert_dict(dstname, srcname):
-    dst = open_dict(dstname)
-    src = open_dict(srcname)
-    dst.delete_all()
-    pc = tools.progress(len(src))
-    for word in src.dumps():
-        pc.next()
-        data = src[word]
-        x = data['oxford']
-        if isinstance(x, int) or isinstance(x, long):
-            if x <= 0:
-                data['oxford'] = None
-        elif isinstance(x, str) or isinstance(x, unicode):
-            if x == '' or x == '0':
-                data['oxford'] = None
-        x = data['collins']
+# 转换时 oxford/collins 为 0 或者空串的统一改成 None
+def convert_record(data):
+    for name in ('oxford', 'collins'):
+        x = data[name]
         if isinstance(x, int) or isinstance(x, long):
             if x <= 0:
-                data['collins'] = None
+                data[name] = None
         elif isinstance(x, str) or isinstance(x, unicode):
             if x == '' or x == '0':
-                data['collins'] = None
-        dst.register(word, data, False)
-    dst.commit()
+                data[name] = None
+    return data
+
+
+# 参与同步比较的字段
+HASH_FIELDS = ('word', 'phonetic', 'definition', 'translation', 'pos',
+               'collins', 'oxford', 'tag', 'bnc', 'frq', 'exchange',
+               'detail', 'audio')
+
+# 取出比较用的字段值：csv 里读不出 None，数字字段为 0 或者空串的、
+# 其它字段为空串（detail 为空对象）的都当作 None，两边才能直接比较
+def record_values(data, names):
+    values = []
+    for name in names:
+        value = data.get(name, None)
+        if name in ('collins', 'oxford', 'bnc', 'frq'):
+            if value in (0, '', '0'):
+                value = None
+        elif not value:
+            value = None
+        values.append(value)
+    return values
+
+# 词条内容的哈希：取 md5 的前 60 位，可以直接存成 sqlite 的整数
+def record_hash(data):
+    values = record_values(data, HASH_FIELDS)
+    text = json.dumps(values, sort_keys=True)
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:15], 16)
+
+
+# 字典转化，csv/sqlite/mysql 之间互转：按单词顺序流式读取源词典，
+# 逐批写入目标，内存占用不随词典大小增长。目标是 sqlite 时使用批量
+# 导入模式（源是 csv 时多进程并行解析），目标是 csv 时直接顺序写文件。
+# 每写完一批在目标里记录进度（csv 目标记在 dstname.resume 文件里），
+# resume 为 True 并且找到上次中断留下的进度时从断点继续，不清空目标
+def convert_dict(dstname, srcname, resume=False):
+    dst_type = dict_type(dstname)
+    name = 'convert:%s' % srcname
+    if dst_type == 'sqlite' and dict_type(srcname) == 'csv':
+        dst = StarDict(dstname)
+        if not (resume and dst.resume_get(name)):
+            dst.delete_all()
+            dst.resume_clear(name)
+        return dst.bulk_import(srcname, resume=name) is not None
+    src = open_dict(srcname)
+    pc = tools.progress(len(src))
+    def records(start_after):
+        for data in src.iter_rows(start_after=start_after):
+            pc.next()
+            yield data['word'], convert_record(data)
+    if dst_type == 'csv':
+        marker = dstname + '.resume'
+        position = None
+        last = None
+        if resume and os.path.exists(marker):
+            with open(marker, 'r') as fp:
+                state = json.load(fp)
+            if state['source'] == srcname and os.path.exists(dstname):
+                if os.path.getsize(dstname) >= state['offset']:
+                    position = state['offset']
+                    last = state['word']
+        if position is None and os.path.exists(marker):
+            os.remove(marker)
+        def checkpoint(word, offset):
+            state = {'source': srcname, 'word': word, 'offset': offset}
+            with open(marker, 'w') as fp:
+                json.dump(state, fp)
+        helper = DictCsv(None)
+        hr = helper.export(dstname, records(last), 'utf-8', position,
+                           checkpoint)
+        if os.path.exists(marker):
+            os.remove(marker)
+    elif dst_type == 'sqlite':
+        dst = StarDict(dstname)
+        last = resume and dst.resume_get(name) or None
+        if last is None:
+            dst.delete_all()
+            dst.resume_clear(name)
+        hr = dst.bulk_load(records(last), resume=name)
+    else:
+        dst = DictMySQL(dstname)
+        last = resume and dst.resume_get(name) or None
+        if last is None:
+            dst.delete_all()
+            dst.resume_clear(name)
+        chunk = []
+        hr = True
+        for record in records(last):
+            chunk.append(record)
+            if len(chunk) >= BATCH_ROWS:
+                if dst.register_many(chunk, True) is None:
+                    hr = None
+                    break
+                dst.resume_set(name, chunk[-1][0])
+                chunk = []
+        if hr is not None:
+            hr = dst.register_many(chunk, True)
+        if hr is not None:
+            dst.resume_clear(name)
     pc.done()
-    return True
+    return hr is not None and hr is not False
+
+
+# 增量同步：目标是 sqlite 时按单词归并两边，只写入改动的行，返回
+# 新增、改动、删除和没变的行数；其它目标没有哈希表，直接完整转换
+def sync_dict(dstname, srcname):
+    if dict_type(dstname) != 'sqlite':
+        return convert_dict(dstname, srcname)
+    src = open_dict(srcname)
+    dst = StarDict(dstname)
+    pc = tools.progress(len(src))
+    def records():
+        for data in src.iter_rows():
+            pc.next()
+            yield data['word'], convert_record(data)
+    hr = dst.sync(records())
+    pc.done()
+    return hr
 
 
 def get_line_phonetic(sd, line):
@@ -1895,6 +5154,517 @@ if __name__ == '__main__':
         print(word['phonetic'])
 
 
+    # 压力测试：N 个读线程 + 1 个批量写入者，比较写入前后读延迟
+    def test7(wal=True, nreaders=8, total=20000):
+        import threading
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), 'stardict_stress.db')
+        for ext in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(dbname + ext):
+                os.remove(dbname + ext)
+        sd = StarDict(dbname, wal=wal)
+        for i in xrange(total):
+            sd.register('word%d' % i, {'translation': 'test %d' % i}, False)
+        sd.commit()
+        state = {'writing': False, 'stop': False}
+        samples = {'idle': [], 'busy': []}
+        lock = threading.Lock()
+
+        def reader(index):
+            rd = StarDict(dbname, readonly=True)
+            count = 0
+            while not state['stop']:
+                key = 'word%d' % ((index * 7919 + count) % total)
+                mode = state['writing'] and 'busy' or 'idle'
+                ts = time.time()
+                rd.query(key)
+                ts = time.time() - ts
+                with lock:
+                    samples[mode].append(ts)
+                count += 1
+            rd.close()
+
+        threads = []
+        for i in xrange(nreaders):
+            threads.append(threading.Thread(target=reader, args=(i,)))
+        for th in threads:
+            th.start()
+        time.sleep(1.0)
+        state['writing'] = True
+        ts = time.time()
+        for i in xrange(total, total * 2):
+            sd.register('word%d' % i, {'translation': 'test %d' % i}, False)
+            if i % 2000 == 0:
+                sd.commit()
+        sd.commit()
+        ts = time.time() - ts
+        state['writing'] = False
+        time.sleep(0.5)
+        state['stop'] = True
+        for th in threads:
+            th.join()
+        print('journal: %s, readers: %d, write: %.3f seconds' % \
+              (sd.journal_mode(), nreaders, ts))
+        for mode in ('idle', 'busy'):
+            data = sorted(samples[mode])
+            if not data:
+                continue
+            p50 = data[len(data) // 2] * 1000
+            p99 = data[int(len(data) * 0.99)] * 1000
+            print('  %s: %d queries, p50=%.3fms p99=%.3fms max=%.3fms' % \
+                  (mode, len(data), p50, p99, data[-1] * 1000))
+        sd.close()
+        return 0
+
+
+    # 字段投影测试：比较只取 word/phonetic/translation 和取整行的开销
+    def test8(total=20000, rounds=5):
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), 'stardict_proj.db')
+        if os.path.exists(dbname):
+            os.remove(dbname)
+        sd = StarDict(dbname)
+        records = []
+        for i in xrange(total):
+            records.append(('word%d' % i, {
+                'phonetic': 'w3:d', 'translation': u'单词 %d' % i,
+                'definition': 'a unit of language. ' * 40,
+                'detail': {'example': ['sentence %d' % n for n in range(30)]},
+                }))
+        sd.register_many(records)
+        keys = ['word%d' % i for i in xrange(total)]
+        fields = ('word', 'phonetic', 'translation')
+        for name, proj in (('full', None), ('projected', fields)):
+            size = 0
+            ts = time.time()
+            for n in xrange(rounds):
+                for key in keys:
+                    obj = sd.query(key, proj)
+                    if n == 0:
+                        size += sum([len(str(v)) for v in obj.values()])
+            ts = time.time() - ts
+            print('%s: %d bytes/row, %.2f us/query' % \
+                  (name, size // total, ts * 1000000 / (total * rounds)))
+        sd.close()
+        return 0
+
+
+    # 内存测试：批量取出全部记录，比较 DictRecord 和普通字典的内存占用
+    def test9(total=20000, fields=None):
+        import tracemalloc
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), 'stardict_proj.db')
+        if not os.path.exists(dbname):
+            test8(total, 1)
+        sd = StarDict(dbname)
+        keys = list(xrange(1, sd.count() + 1))
+        for name in ('record', 'dict'):
+            tracemalloc.start()
+            rows = sd.query_batch(keys, fields)
+            if name == 'dict':
+                rows = [row.to_dict() for row in rows]
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print('%s: %d rows, %.1f MB' % (name, len(rows), size / 1048576.0))
+            rows = None
+        sd.close()
+        return 0
+
+
+    # 临时目录里的测试数据库，删除上次留下的数据库和拼写索引
+    def temp_dbname(name):
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), name)
+        for fn in (dbname, dbname + '.spell'):
+            if os.path.exists(fn):
+                os.remove(fn)
+        return dbname
+
+    # total 个由常用字母组成的随机单词，seed 相同时结果相同，返回
+    # {word: {'frq': n}}
+    def random_words(total, seed=1, minsize=2):
+        import random
+        rnd = random.Random(seed)
+        words = {}
+        while len(words) < total:
+            size = rnd.randint(minsize, 12)
+            word = ''.join([rnd.choice('etaoinshrdlu') for n in xrange(size)])
+            words[word] = {'frq': rnd.randint(0, 60000)}
+        return words
+
+    # 新建测试数据库并写入随机单词，返回 (词典, 单词表)
+    def make_random_dict(name, total, seed=1, minsize=2):
+        sd = StarDict(temp_dbname(name))
+        words = random_words(total, seed, minsize)
+        sd.register_many(list(words.items()))
+        return sd, words
+
+    # 全文搜索测试：FTS5 索引和 LIKE 全表扫描对比
+    def test10(total=200000, rounds=20):
+        import random
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), 'stardict_fts.db')
+        if os.path.exists(dbname):
+            os.remove(dbname)
+        sd = StarDict(dbname)
+        vocab = ['word%d' % i for i in xrange(50000)]
+        rnd = random.Random(1)
+        records = []
+        for i in xrange(total):
+            text = ' '.join([rnd.choice(vocab) for n in xrange(12)])
+            records.append(('entry%d' % i, {'definition': text}))
+        sd.register_many(records)
+        ts = time.time()
+        sd.fts_enable()
+        print('fts build: %.2f seconds' % (time.time() - ts))
+        conn = sqlite3.connect(dbname)
+        terms = [rnd.choice(vocab) for n in xrange(rounds)]
+        ts = time.time()
+        for term in terms:
+            sql = 'select id, word from stardict where definition like ? limit 10;'
+            conn.execute(sql, ('%' + term + ' %',)).fetchall()
+        t1 = (time.time() - ts) * 1000 / rounds
+        ts = time.time()
+        for term in terms:
+            sd.search_definition(term, 10)
+        t2 = (time.time() - ts) * 1000 / rounds
+        print('like scan: %.3f ms/query, fts5: %.3f ms/query' % (t1, t2))
+        conn.close()
+        sd.close()
+        return 0
+
+
+    # 前缀补全测试：建表耗时和查询延迟分布
+    def test11(total=200000, rounds=20000):
+        import random
+        sd, words = make_random_dict('stardict_prefix.db', total)
+        rnd = random.Random(1)
+        ts = time.time()
+        sd.autocomplete_enable()
+        print('build: %.2f seconds' % (time.time() - ts))
+        samples = []
+        keys = list(words.keys())
+        for n in xrange(rounds):
+            word = rnd.choice(keys)
+            prefix = word[:rnd.randint(1, len(word))]
+            ts = time.time()
+            sd.autocomplete(prefix, 10)
+            samples.append(time.time() - ts)
+        samples.sort()
+        p50 = samples[len(samples) // 2] * 1000
+        p99 = samples[int(len(samples) * 0.99)] * 1000
+        print('autocomplete: p50=%.3fms p99=%.3fms' % (p50, p99))
+        sd.close()
+        return 0
+
+    def test12(total=100000, rounds=2000):
+        import random
+        sd, words = make_random_dict('stardict_spell.db', total, 1, 3)
+        rnd = random.Random(1)
+        ts = time.time()
+        sd.spell_rebuild()
+        print('build: %.2f seconds' % (time.time() - ts))
+        keys = list(words.keys())
+        typos = []
+        for n in xrange(rounds):
+            word = list(rnd.choice(keys))
+            pos = rnd.randint(0, len(word) - 1)
+            word[pos] = rnd.choice('etaoinshrdlu')
+            typos.append(''.join(word))
+        ts = time.time()
+        for word in typos:
+            sd.suggest(word, 2, 5)
+        t = time.time() - ts
+        print('suggest: %.1f queries/sec' % (rounds / max(t, 0.000001)))
+        # 删除一个再注册一个，数量不变，索引也要跟着更新
+        for dc in (sd, DictCsv(None)):
+            dc.register('recipe', {'frq': 10})
+            assert dc.suggest('recipe', 0) == [('recipe', 0)]
+            dc.remove('recipe')
+            dc.register('zzzzz', {'frq': 10})
+            assert dc.suggest('recipe', 0) == []
+            assert dc.suggest('zzzzz', 0) == [('zzzzz', 0)]
+        sd.close()
+        return 0
+
+    def test13(total=200000, rounds=200):
+        import fnmatch
+        sd, words = make_random_dict('stardict_pattern.db', total)
+        ts = time.time()
+        sd.pattern_enable()
+        print('build: %.2f seconds' % (time.time() - ts))
+        patterns = ['s?t*', '??r????', '*tion', 'a*e', 'h?*?s']
+        names = sd.dumps()
+        for pattern in patterns:
+            ts = time.time()
+            for n in xrange(rounds):
+                sd.pattern_search(pattern, 20)
+            t1 = (time.time() - ts) * 1000 / rounds
+            regex = re.compile(fnmatch.translate(pattern), re.I)
+            ts = time.time()
+            for n in xrange(max(1, rounds // 20)):
+                [w for w in names if regex.match(w)]
+            t2 = (time.time() - ts) * 1000 / max(1, rounds // 20)
+            print('%-8s index=%.3fms scan=%.3fms' % (pattern, t1, t2))
+        sd.close()
+        return 0
+
+    def test14(total=200000, rounds=1000):
+        import random
+        sd, words = make_random_dict('stardict_anagram.db', total)
+        rnd = random.Random(1)
+        keys = list(words.keys())
+        ts = time.time()
+        for n in xrange(rounds):
+            sd.anagrams(rnd.choice(keys))
+        t1 = (time.time() - ts) * 1000 / rounds
+        names = sd.dumps()
+        ts = time.time()
+        for n in xrange(5):
+            sig = word_signature(rnd.choice(keys))
+            [w for w in names if word_signature(stripword(w)) == sig]
+        t2 = (time.time() - ts) * 1000 / 5
+        print('anagrams: index=%.3fms scan=%.3fms' % (t1, t2))
+        ts = time.time()
+        for n in xrange(rounds // 10):
+            sd.sub_anagrams(''.join(rnd.sample('etaoinshrdlu', 7)), 3)
+        t3 = (time.time() - ts) * 1000 / (rounds // 10)
+        print('sub_anagrams: %.3fms' % t3)
+        sd.close()
+        return 0
+
+    def test15(total=200000, rounds=1000):
+        import random
+        sd = StarDict(temp_dbname('stardict_sound.db'))
+        words = random_words(total)
+        rnd = random.Random(1)
+        ts = time.time()
+        sd.register_many(list(words.items()))
+        print('load: %.2f seconds' % (time.time() - ts))
+        keys = list(words.keys())
+        ts = time.time()
+        for n in xrange(rounds):
+            sd.sounds_like(rnd.choice(keys))
+        t1 = (time.time() - ts) * 1000 / rounds
+        names = sd.dumps()
+        ts = time.time()
+        key = metaphone(rnd.choice(keys))
+        [w for w in names if metaphone(w) == key]
+        t2 = (time.time() - ts) * 1000
+        print('sounds_like: index=%.3fms scan=%.3fms' % (t1, t2))
+        sd.close()
+        return 0
+
+    def test16(total=200000, rounds=200):
+        sd, words = make_random_dict('stardict_suffix.db', total)
+        names = sd.dumps()
+        for suffix in ('tion', 'ight', 'ness', 'e'):
+            ts = time.time()
+            for n in xrange(rounds):
+                sd.ends_with(suffix, 20)
+            t1 = (time.time() - ts) * 1000 / rounds
+            ts = time.time()
+            [w for w in names if stripword(w).endswith(suffix)]
+            t2 = (time.time() - ts) * 1000
+            print('%-5s index=%.3fms scan=%.3fms' % (suffix, t1, t2))
+        sd.close()
+        return 0
+
+    # 韵脚从最后一个主重音的元音算起，只有词尾的 ə 相同不算押韵
+    def test16_rhyme():
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), 'stardict_rhyme.db')
+        if os.path.exists(dbname):
+            os.remove(dbname)
+        assert rhyme_key(u'ˈbɑ:tə') != rhyme_key(u'ˈwɔ:tə')
+        assert rhyme_key(u'ˈbɑ:tə') == u'ɑːtə'
+        assert rhyme_key(u"ə'baut") == u'aut'
+        assert rhyme_key(u'kæt') == u'æt'
+        sd = StarDict(dbname)
+        sd.register('barter', {'phonetic': u'ˈbɑ:tə'})
+        sd.register('martyr', {'phonetic': u'ˈmɑ:tə'})
+        sd.register('water', {'phonetic': u'ˈwɔ:tə'})
+        sd.register('butter', {'phonetic': u'ˈbʌtə'})
+        result = [w for _, w in sd.rhymes('barter')]
+        assert result == ['martyr'], result
+        print('rhymes: barter -> %s' % result)
+        sd.close()
+        return 0
+
+    def test17(total=200000, rounds=20):
+        import random
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), 'stardict_tag.db')
+        if os.path.exists(dbname):
+            os.remove(dbname)
+        sd = StarDict(dbname)
+        rnd = random.Random(1)
+        records = []
+        for n in xrange(total):
+            tag = ' '.join([t for t in TAG_NAMES if rnd.random() < 0.1])
+            records.append(('w%d' % n, {'tag': tag, 'frq': rnd.randint(0, 60000)}))
+        sd.register_many(records)
+        ts = time.time()
+        for n in xrange(rounds):
+            r1 = len(list(sd.select_words(['toefl'], ['cet6'], frq_max=30000)))
+        t1 = (time.time() - ts) * 1000 / rounds
+        ts = time.time()
+        for n in xrange(rounds):
+            r2 = 0
+            for record in sd.select_words(fields=('tag', 'frq')):
+                tags = (record['tag'] or '').split()
+                frq = record['frq']
+                if 'toefl' in tags and 'cet6' not in tags:
+                    if frq and frq <= 30000:
+                        r2 += 1
+        t2 = (time.time() - ts) * 1000 / rounds
+        print('select_words: %d rows index=%.3fms scan=%.3fms' % (r1, t1, t2))
+        sd.close()
+        return 0
+
+    def test19(total=200000):
+        records = []
+        for word, items in random_words(total, 1, 3).items():
+            items.update({'phonetic': word[:4], 'tag': 'cet4',
+                          'definition': 'n. ' + word})
+            records.append((word, items))
+        for mode in ('register', 'bulk_load'):
+            sd = StarDict(temp_dbname('stardict_bulk.db'))
+            ts = time.time()
+            if mode == 'register':
+                for word, items in records:
+                    sd.register(word, items, False)
+                sd.commit()
+            else:
+                sd.bulk_load(records)
+            t = time.time() - ts
+            print('%s: %.2f seconds, %.1f rows/sec' % (mode, t, total / t))
+            sd.close()
+        return 0
+
+    def test20(csvname, workers=(1, 2, 4, 8), codec='utf-8'):
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), 'stardict_import.db')
+        for n in workers:
+            if os.path.exists(dbname):
+                os.remove(dbname)
+            sd = StarDict(dbname)
+            hr = sd.bulk_import(csvname, n, codec)
+            print('workers=%d: %.2f seconds, %.1f rows/sec' % \
+                  (n, hr['seconds'], hr['rate']))
+            # id 连续，并且和 DictCsv 读取时的顺序相同
+            rows = [(id - 1, word) for id, word in sd]
+            assert rows == list(DictCsv(csvname, codec, False))
+            sd.close()
+        return 0
+
+    # 断点续传：写到一半中断，再从进度标记继续
+    def test22(count=100000, size=10000):
+        import tempfile
+        dbname = os.path.join(tempfile.gettempdir(), 'stardict_resume.db')
+        if os.path.exists(dbname):
+            os.remove(dbname)
+        words = sorted(['word%06d' % i for i in xrange(count)])
+        def records(start_after, stop):
+            for word in words:
+                if start_after is not None and word <= start_after:
+                    continue
+                if word == stop:
+                    raise KeyboardInterrupt
+                yield word, {'frq': len(word)}
+        sd = StarDict(dbname)
+        try:
+            sd.bulk_load(records(None, words[count // 2 + 1]), size, 'test')
+        except KeyboardInterrupt:
+            pass
+        last = sd.resume_get('test')
+        print('interrupted: %d rows, marker %s' % (sd.count(), last))
+        hr = sd.bulk_load(records(last, None), size, 'test')
+        print('resumed: %d rows, %d written, marker %s' % \
+              (sd.count(), hr['changes'], sd.resume_get('test')))
+        sd.close()
+        return 0
+
+    # 增量同步：第一次补算全部哈希，之后只写入改动的行
+    def test23(dbname, csvname):
+        for i in xrange(2):
+            hr = sync_dict(dbname, csvname)
+            print('sync: %d inserted, %d updated, %d deleted, %d same' % \
+                  (hr['insert'], hr['update'], hr['delete'], hr['same']))
+            print('%.2f seconds' % hr['seconds'])
+        return 0
+
+    # 往返转换以后逐字段比较应该没有差异
+    def test24_roundtrip():
+        import tempfile
+        base = os.path.join(tempfile.gettempdir(), 'stardict_diff')
+        for name in (base + '.db', base + '.csv'):
+            if os.path.exists(name):
+                os.remove(name)
+        sd = StarDict(base + '.db')
+        sd.register('apple', {'translation': 'fruit', 'frq': 5})
+        sd.register('zoo', {'definition': 'animals'})
+        sd.commit()
+        convert_dict(base + '.csv', base + '.db')
+        diff = list(tools.discrepancy_diff(sd, DictCsv(base + '.csv')))
+        assert diff == [], diff
+        print('round trip: no differences')
+        sd.close()
+        return 0
+
+    # 往返转换以后的同步不应该改写任何行
+    def test23_roundtrip():
+        import tempfile
+        base = os.path.join(tempfile.gettempdir(), 'stardict_sync')
+        for name in (base + '.db', base + '.csv'):
+            if os.path.exists(name):
+                os.remove(name)
+        sd = StarDict(base + '.db')
+        sd.register('apple', {'translation': 'fruit', 'frq': 5})
+        sd.register('zoo', {'definition': 'animals'})
+        sd.commit()
+        sd.close()
+        convert_dict(base + '.csv', base + '.db')
+        hr = sync_dict(base + '.db', base + '.csv')
+        assert (hr['insert'], hr['update'], hr['delete']) == (0, 0, 0), hr
+        assert hr['same'] == 2, hr
+        print('round trip: no-op sync')
+        return 0
+
+    # 逐字段比较两个词典，统计每个字段不同的单词数
+    def test24(left, right):
+        counter = {}
+        t = time.time()
+        for word, a, b, names in tools.discrepancy_diff(open_dict(left),
+                                                        open_dict(right)):
+            if a is None or b is None:
+                names = (a is None) and ('+',) or ('-',)
+            for name in names:
+                counter[name] = counter.get(name, 0) + 1
+        for name in sorted(counter):
+            print('%s: %d' % (name, counter[name]))
+        print('%.2f seconds' % (time.time() - t))
+        return 0
+
+    # csv 索引文件：完整读入和 mmap 延迟解析的打开时间
+    def test25(csvname):
+        t = time.time()
+        dc = DictCsv(csvname, sidecar=False)
+        print('full open: %.3f seconds, %d rows' % (time.time() - t, len(dc)))
+        t = time.time()
+        csv_index_build(csvname)
+        print('build index: %.3f seconds' % (time.time() - t))
+        t = time.time()
+        dc = DictCsv(csvname)
+        print('indexed open: %.3f seconds, %d rows' % (time.time() - t, len(dc)))
+        t = time.time()
+        for word in ('apple', 'banana', 'kiwi', 'zoo') * 250:
+            dc.query(word)
+        print('1000 queries: %.3f seconds' % (time.time() - t))
+        dc.close()
+        return 0
+
+
     sd = StarDict(db, False)
     line = raw_input()
     # line=line.decode('utf-8')